@@ -0,0 +1,208 @@
+"""
+Measure the cost of TLS handshakes through L{SNIMap}.
+
+Handshakes are driven entirely in memory, between a pyOpenSSL client
+connection and the server connection L{SNIMap.serverConnectionForTLS}
+creates, so the numbers reflect txsni and OpenSSL rather than the network.
+
+Usage, from the root of a checkout::
+
+    PYTHONPATH=. python benchmarks/handshakes.py [--count N] [--hosts N] \\
+        [--output FILE]
+
+Results are written as JSON: one object per scenario, with the number of
+handshakes, handshakes per second and the median and 99th percentile
+latency in microseconds, or the error that stopped the scenario.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+from OpenSSL.SSL import Connection, Context, SSLv23_METHOD, WantReadError
+
+from twisted.internet import interfaces, protocol
+from twisted.python.filepath import FilePath
+
+from zope.interface import implementer
+
+from txsni.snimap import HostDirectoryMap, SNIMap
+from txsni.store import CertificateStore, buildStore
+from txsni.test.certs.cert_builder import (
+    DEFAULT_CERT_PATH, _build_certs, _build_root_cert, _build_single_leaf,
+)
+
+
+@implementer(interfaces.IProtocolNegotiationFactory)
+class _NegotiatingFactory(protocol.Factory):
+    def acceptableProtocols(self):
+        return [b'h2', b'http/1.1']
+
+
+
+class _FakeTLSProtocol(object):
+    """
+    Just enough of a L{TLSMemoryBIOProtocol} for Twisted's ALPN callbacks,
+    which find the protocols to offer through the connection's app data.
+    """
+    def __init__(self):
+        self.factory = protocol.Factory()
+        self.factory.wrappedFactory = _NegotiatingFactory()
+
+
+
+def handshake(sniMap, clientContext, hostname=None):
+    """
+    Perform one TLS handshake against C{sniMap} in memory.
+
+    @return: the client connection.
+    """
+    tlsProtocol = _FakeTLSProtocol()
+    server = sniMap.serverConnectionForTLS(tlsProtocol)
+    server.set_app_data(tlsProtocol)
+    server.set_accept_state()
+    client = Connection(clientContext, None)
+    if hostname is not None:
+        client.set_tlsext_host_name(hostname)
+    client.set_connect_state()
+
+    done = set()
+    while len(done) < 2:
+        for name, source, destination in [('client', client, server),
+                                          ('server', server, client)]:
+            try:
+                source.do_handshake()
+            except WantReadError:
+                pass
+            else:
+                done.add(name)
+            try:
+                data = source.bio_read(65536)
+            except WantReadError:
+                pass
+            else:
+                destination.bio_write(data)
+    return client
+
+
+
+def measure(count, makeSNIMap, clientContext, hostnames):
+    """
+    Time C{count} handshakes, cycling through C{hostnames}.
+
+    @param makeSNIMap: A callable returning the L{SNIMap} to use; it is
+        called for every handshake, so it decides whether state is shared.
+
+    @return: a L{dict} of results.
+    """
+    latencies = []
+    for i in range(count):
+        sniMap = makeSNIMap()
+        hostname = hostnames[i % len(hostnames)]
+        before = time.perf_counter()
+        handshake(sniMap, clientContext, hostname)
+        latencies.append(time.perf_counter() - before)
+    latencies.sort()
+    return {
+        'handshakes': count,
+        'handshakes_per_second': count / sum(latencies),
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[min(len(latencies) - 1,
+                                int(len(latencies) * 0.99))] * 1e6,
+    }
+
+
+
+def buildDirectory(hosts):
+    """
+    Build a certificate directory with C{DEFAULT.pem} and certificates for
+    C{hosts} host names.
+
+    @return: the L{FilePath} of the directory, and the host names.
+    """
+    _build_certs()
+    caCert, caKey = _build_root_cert()
+    directory = FilePath(tempfile.mkdtemp())
+    FilePath(DEFAULT_CERT_PATH).copyTo(directory.child('DEFAULT.pem'))
+    hostnames = []
+    for i in range(hosts):
+        hostname = u'host%d.example.com' % (i,)
+        _build_single_leaf(hostname, directory.child(hostname + u'.pem').path,
+                           caCert, caKey)
+        hostnames.append(hostname.encode('ascii'))
+    directory.child('acme').makedirs()
+    FilePath(DEFAULT_CERT_PATH).copyTo(
+        directory.child('acme').child(hostnames[0].decode('ascii') + '.pem')
+    )
+    return directory, hostnames
+
+
+
+def scenarios(directory, hostnames):
+    """
+    The scenarios to measure, as (name, makeSNIMap, clientContext,
+    hostnames) tuples.
+    """
+    def warm(acme=False):
+        sniMap = SNIMap(HostDirectoryMap(directory),
+                        HostDirectoryMap(directory.child('acme'))
+                        if acme else None)
+        return lambda: sniMap
+
+    def cold():
+        return SNIMap(HostDirectoryMap(directory))
+
+    def client(protocols=None):
+        context = Context(SSLv23_METHOD)
+        if protocols is not None:
+            context.set_alpn_protos(protocols)
+        return context
+
+    yield 'default', warm(), client(), [None]
+    yield 'one-host', warm(), client(), hostnames[:1]
+    yield 'many-hosts', warm(), client(), hostnames
+    yield 'alpn', warm(), client([b'h2', b'http/1.1']), hostnames[:1]
+    if hasattr(Context, 'set_npn_select_callback'):
+        npnClient = client()
+        npnClient.set_npn_select_callback(lambda conn, protocols: b'h2')
+        yield 'npn', warm(), npnClient, hostnames[:1]
+    yield 'acme', warm(acme=True), client([b'acme-tls/1']), hostnames[:1]
+    yield 'cold-mapping', cold, client(), hostnames[:1]
+    yield 'warm-mapping', warm(), client(), hostnames[:1]
+    storePath = FilePath(tempfile.mktemp())
+    buildStore(directory, storePath)
+    storeMap = SNIMap(CertificateStore(storePath))
+    yield 'store-many-hosts', lambda: storeMap, client(), hostnames
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=500,
+                        help='handshakes per scenario')
+    parser.add_argument('--hosts', type=int, default=50,
+                        help='host names in the many-hosts scenario')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='where to write the JSON')
+    options = parser.parse_args(argv)
+
+    directory, hostnames = buildDirectory(options.hosts)
+    results = {}
+    for name, makeSNIMap, clientContext, names in scenarios(directory,
+                                                            hostnames):
+        try:
+            results[name] = measure(options.count, makeSNIMap, clientContext,
+                                    names)
+        except Exception as e:
+            results[name] = {'error': repr(e)}
+    json.dump(results, options.output, indent=2, sort_keys=True)
+    options.output.write('\n')
+
+
+
+if __name__ == '__main__':
+    main()
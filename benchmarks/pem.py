@@ -0,0 +1,204 @@
+"""
+Compare the PEM parser with the line-by-line one it replaced.
+
+Each input is a key and leaf certificate followed by a chain bundle of a
+given number of distinct certificates, with LF or CRLF line endings, so
+that neither parser is spared work by the interning the new one does
+within a file.  Both splitting the file into blocks and building the
+L{CertificateOptions} for it are timed.
+
+Loading many hosts that share a certificate and its chain is also timed,
+with and without an L{Interner}, along with the number of distinct
+objects each way.
+
+Usage, from the root of a checkout::
+
+    PYTHONPATH=. python benchmarks/pem.py [--repeat N] [--output FILE]
+
+Results are written as JSON: for each input, the median time in
+microseconds of each implementation.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import sys
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from OpenSSL.SSL import FILETYPE_PEM
+
+from twisted.internet.ssl import Certificate, CertificateOptions, KeyPair
+
+from txsni.only_noticed_pypi_pem_after_i_wrote_this import (
+    Interner, PEMObjects, _splitPEM, certificateOptionsFromPileOfPEM,
+)
+from txsni.test.certs.cert_builder import HTTP2BIN_CERT_PATH, _build_certs
+
+
+def _lineSplitPEM(pemdata):
+    """
+    The block splitting of the original C{objectsFromPEM}.
+    """
+    certificates = []
+    keys = []
+    blobs = [b""]
+    for line in pemdata.split(b"\n"):
+        if line.startswith(b'-----BEGIN'):
+            if b'CERTIFICATE' in line:
+                blobs = certificates
+            else:
+                blobs = keys
+            blobs.append(b'')
+        blobs[-1] += line
+        blobs[-1] += b'\n'
+    return PEMObjects(keys=keys, certificates=certificates)
+
+
+
+def _lineCertificateOptions(pemdata):
+    """
+    The original C{certificateOptionsFromPileOfPEM}.
+    """
+    blobs = _lineSplitPEM(pemdata)
+    keys = [KeyPair.load(key, FILETYPE_PEM) for key in blobs.keys]
+    certificates = [Certificate.loadPEM(certificate)
+                    for certificate in blobs.certificates]
+    privateKey = keys[0]
+    certificatesByFingerprint = dict(
+        [(certificate.getPublicKey().keyHash(), certificate)
+         for certificate in certificates]
+    )
+    openSSLCert = certificatesByFingerprint.pop(privateKey.keyHash()).original
+    openSSLChain = [c.original for c in certificatesByFingerprint.values()]
+    return CertificateOptions(certificate=openSSLCert,
+                              privateKey=privateKey.original,
+                              extraCertChain=openSSLChain)
+
+
+
+def median(repeat, function, argument):
+    """
+    The median time, in microseconds, of C{repeat} calls of C{function}.
+    """
+    times = []
+    for _ in range(repeat):
+        before = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - before)
+    times.sort()
+    return times[len(times) // 2] * 1e6
+
+
+
+def chainBundle(count):
+    """
+    C{count} distinct self-signed certificates, PEM encoded.
+
+    They share one ECDSA key, which is cheap to sign with and matches no
+    private key in the inputs, but differ in subject and serial number, so
+    each must be parsed.
+    """
+    key = ec.generate_private_key(ec.SECP256R1())
+    now = datetime.datetime.now(datetime.timezone.utc)
+    bundle = []
+    for serial in range(1, count + 1):
+        name = x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME,
+                               u'Chain Certificate %d' % (serial,)),
+        ])
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(serial)
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=365))
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                           critical=True)
+            .sign(key, hashes.SHA256())
+        )
+        bundle.append(certificate.public_bytes(serialization.Encoding.PEM))
+    return b''.join(bundle)
+
+
+
+def inputs():
+    """
+    The inputs to measure, as (name, PEM data) pairs.
+    """
+    _build_certs()
+    with open(HTTP2BIN_CERT_PATH, 'rb') as f:
+        leaf = f.read()
+    for chainLength in [1, 10, 100, 1000]:
+        pemdata = leaf + chainBundle(chainLength)
+        yield 'chain-%d' % (chainLength,), pemdata
+        yield 'chain-%d-crlf' % (chainLength,), pemdata.replace(b'\n',
+                                                                 b'\r\n')
+
+
+
+def interning(hosts, pemdata):
+    """
+    Load C{pemdata} for C{hosts} hosts, without and then with interning.
+
+    @return: a L{dict} of results.
+    """
+    before = time.perf_counter()
+    loaded = [certificateOptionsFromPileOfPEM(pemdata) for _ in range(hosts)]
+    without = time.perf_counter() - before
+    objects = sum(2 + len(options.extraCertChain) for options in loaded)
+    del loaded
+
+    interner = Interner()
+    before = time.perf_counter()
+    loaded = [certificateOptionsFromPileOfPEM(pemdata, interner)
+              for _ in range(hosts)]
+    interned = time.perf_counter() - before
+    return {
+        'hosts': hosts,
+        'load_us': without * 1e6,
+        'load_interned_us': interned * 1e6,
+        'objects': objects,
+        'objects_interned': len(interner) - 1,
+    }
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs of each implementation per input')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='where to write the JSON')
+    options = parser.parse_args(argv)
+
+    results = {}
+    for name, pemdata in inputs():
+        results[name] = {
+            'bytes': len(pemdata),
+            'split_lines_us': median(options.repeat, _lineSplitPEM, pemdata),
+            'split_offsets_us': median(options.repeat, _splitPEM, pemdata),
+            'options_lines_us': median(options.repeat,
+                                       _lineCertificateOptions, pemdata),
+            'options_offsets_us': median(options.repeat,
+                                         certificateOptionsFromPileOfPEM,
+                                         pemdata),
+        }
+    with open(HTTP2BIN_CERT_PATH, 'rb') as f:
+        shared = f.read() + chainBundle(3)
+    results['interning-1000-hosts'] = interning(1000, shared)
+    json.dump(results, options.output, indent=2, sort_keys=True)
+    options.output.write('\n')
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Measure how L{SNIMap} scales with the number of hosts.
+
+For each host count, a directory of synthetic ECDSA hosts is generated (or
+reused from the fixture cache; see L{txsni.test.certs.synthetic}) and
+served through each mapping in turn, each in a fresh process:
+
+    - C{directory}: a L{HostDirectoryMap}, loading hosts as they are asked
+      for;
+    - C{store}: a L{CertificateStore} compiled from the directory, and
+      cached beside it;
+    - C{san}: a L{SANDirectoryMap}, loading every host up front and looked up
+      by the other name each certificate covers.
+
+Usage, from the root of a checkout::
+
+    PYTHONPATH=. python benchmarks/scaling.py [--hosts 10,100,...] \\
+        [--mappings directory,store,san] [--sample N] [--output FILE]
+
+Results are written as JSON, keyed by mapping and host count: the seconds
+from creating the mapping to the end of the first handshake, the median and
+99th percentile latency in microseconds of the first and of a second
+handshake with each of C{--sample} hosts, and the resident memory added, in
+total and per host loaded.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from OpenSSL.SSL import Context, SSLv23_METHOD
+
+from twisted.python.filepath import FilePath
+
+from handshakes import handshake
+
+from txsni.sanmap import SANDirectoryMap
+from txsni.snimap import HostDirectoryMap, SNIMap
+from txsni.store import CertificateStore, buildStore
+from txsni.test.certs.synthetic import syntheticHosts
+
+
+def residentBytes():
+    """
+    The resident memory of this process, or its peak on platforms without
+    C{/proc}.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except IOError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[min(len(latencies) - 1,
+                                int(len(latencies) * 0.99))] * 1e6,
+    }
+
+
+
+def _storePath(hosts):
+    """
+    The store compiled from C{hosts}, which is cached beside them.
+    """
+    storePath = hosts.directory.sibling('hosts.store')
+    if not storePath.exists():
+        scratch = FilePath(tempfile.mktemp(dir=storePath.dirname()))
+        buildStore(hosts.directory, scratch)
+        scratch.moveTo(storePath)
+    return storePath
+
+
+
+def _makeMapping(name, hosts):
+    """
+    Make mapping C{name} for C{hosts}.
+
+    @return: the mapping, the host names to look up and the number of hosts
+        it loads up front.
+    """
+    if name == 'directory':
+        return HostDirectoryMap(hosts.directory), hosts.hostnames, 0
+    if name == 'store':
+        return CertificateStore(_storePath(hosts)), hosts.hostnames, 0
+    if name == 'san':
+        return (SANDirectoryMap(hosts.directory), hosts.alternativeNames,
+                hosts.count + 1)
+    raise ValueError("Unknown mapping %r" % (name,))
+
+
+
+def measure(mappingName, count, sample):
+    """
+    Measure mapping C{mappingName} serving C{count} hosts, handshaking with
+    C{sample} of them.
+
+    @return: a L{dict} of results.
+    """
+    hosts = syntheticHosts(count)
+    clientContext = Context(SSLv23_METHOD)
+    before = residentBytes()
+    started = time.perf_counter()
+    mapping, hostnames, loaded = _makeMapping(mappingName, hosts)
+    sniMap = SNIMap(mapping)
+    handshake(sniMap, clientContext, hostnames[0])
+    coldStart = time.perf_counter() - started
+
+    names = random.Random(count).sample(hostnames, min(sample, count))
+    results = {'hosts': count, 'cold_start_s': coldStart}
+    for phase in ['first', 'second']:
+        latencies = []
+        for name in names:
+            began = time.perf_counter()
+            handshake(sniMap, clientContext, name)
+            latencies.append(time.perf_counter() - began)
+        for key, value in _percentiles(latencies).items():
+            results['%s_%s' % (phase, key)] = value
+    added = residentBytes() - before
+    results['rss_added_bytes'] = added
+    results['rss_per_host_bytes'] = added // max(loaded, len(names))
+    return results
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--hosts', default='10,100,1000,10000,100000',
+                        help='comma separated host counts')
+    parser.add_argument('--mappings', default='directory,store,san',
+                        help='comma separated mappings to measure')
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='hosts to handshake with at each count')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='where to write the JSON')
+    options = parser.parse_args(argv)
+
+    counts = [int(count) for count in options.hosts.split(',')]
+    results = {}
+    for count in counts:
+        # Generate each directory, and compile its store, once, before the
+        # measurements using them.
+        hosts = syntheticHosts(count)
+        if 'store' in options.mappings.split(','):
+            _storePath(hosts)
+        for mappingName in options.mappings.split(','):
+            print("%s: %d hosts" % (mappingName, count), file=sys.stderr)
+            with ProcessPoolExecutor(1) as process:
+                result = process.submit(measure, mappingName, count,
+                                        options.sample).result()
+            results.setdefault(mappingName, []).append(result)
+    json.dump(results, options.output, indent=2, sort_keys=True)
+    options.output.write('\n')
+
+
+
+if __name__ == '__main__':
+    main()
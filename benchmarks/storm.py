@@ -0,0 +1,184 @@
+"""
+Measure the latency of an established connection during a handshake storm.
+
+A txsni server echoes whatever it is sent.  A separate client process keeps
+one TLS connection open, sending a small message and timing its echo every
+few milliseconds, while a number of threads open new connections to the
+server as fast as they can, each performing a full handshake and closing.
+The server runs handshakes in the reactor thread, as usual, or in a
+L{txsni.offload.HandshakePool}.
+
+Usage, from the root of a checkout::
+
+    PYTHONPATH=. python benchmarks/storm.py [--seconds N] [--storm N] \\
+        [--threads N] [--output FILE]
+
+Results are written as JSON: for the server with and without a pool, the
+median and 99th percentile echo latency in microseconds, measured with and
+without a storm, and the number of handshakes the storm completed per
+second.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+from twisted.internet import endpoints, protocol, reactor
+from twisted.python.filepath import FilePath
+
+from txsni.offload import HandshakePool
+from txsni.snimap import HostDirectoryMap, SNIMap
+from txsni.test.certs.cert_builder import CERT_DIR, _build_certs
+from txsni.tlsendpoint import TLSEndpoint
+
+
+class _Echo(protocol.Protocol):
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[min(len(latencies) - 1,
+                                int(len(latencies) * 0.99))] * 1e6,
+    }
+
+
+
+def _clientContext():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+
+def client(port, seconds, stormers):
+    """
+    Time echoes on one connection for C{seconds}, while C{stormers} threads
+    make new connections, and print the results as JSON.
+    """
+    context = _clientContext()
+    stop = threading.Event()
+    handshakes = [0]
+
+    def storm():
+        while not stop.is_set():
+            with socket.create_connection(('127.0.0.1', port)) as raw:
+                with context.wrap_socket(raw, server_hostname='http2bin.org'):
+                    handshakes[0] += 1
+
+    raw = socket.create_connection(('127.0.0.1', port))
+    raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connection = context.wrap_socket(raw, server_hostname='http2bin.org')
+    threads = [threading.Thread(target=storm) for _ in range(stormers)]
+    for thread in threads:
+        thread.start()
+    latencies = []
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        before = time.perf_counter()
+        connection.sendall(b'ping')
+        connection.recv(4)
+        latencies.append(time.perf_counter() - before)
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in threads:
+        thread.join()
+    connection.close()
+    result = _percentiles(latencies)
+    result['handshakes_per_second'] = handshakes[0] / elapsed
+    json.dump(result, sys.stdout)
+
+
+
+def serve(handshakeThreads):
+    """
+    Listen on a free port, print it, and echo until stdin closes.
+    """
+    _build_certs()
+    pool = (HandshakePool(reactor, handshakeThreads)
+            if handshakeThreads else None)
+    endpoint = TLSEndpoint(
+        endpoints.TCP4ServerEndpoint(reactor, 0, interface='127.0.0.1'),
+        SNIMap(HostDirectoryMap(FilePath(CERT_DIR))),
+        handshakePool=pool,
+    )
+
+    def listening(port):
+        print(port.getHost().port)
+        sys.stdout.flush()
+        reactor.callInThread(lambda: (sys.stdin.read(),
+                                      reactor.callFromThread(reactor.stop)))
+
+    endpoint.listen(protocol.Factory.forProtocol(_Echo)).addCallback(
+        listening)
+    reactor.run()
+
+
+
+def _run(handshakeThreads, seconds, stormers):
+    environ = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    server = subprocess.Popen(
+        [sys.executable, __file__, '--serve', str(handshakeThreads)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environ,
+    )
+    try:
+        port = server.stdout.readline().strip().decode('ascii')
+        results = {}
+        for name, count in [('idle', 0), ('storm', stormers)]:
+            output = subprocess.check_output(
+                [sys.executable, __file__, '--client', port, str(seconds),
+                 str(count)], env=environ,
+            )
+            results[name] = json.loads(output)
+        return results
+    finally:
+        server.stdin.close()
+        server.wait()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=5,
+                        help='how long to measure for')
+    parser.add_argument('--storm', type=int, default=8,
+                        help='threads making new connections')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1,
+                        help='threads in the handshake pool')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--client', nargs=3, type=float,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='where to write the JSON')
+    options = parser.parse_args(argv)
+
+    if options.serve is not None:
+        return serve(options.serve)
+    if options.client is not None:
+        port, seconds, stormers = options.client
+        return client(int(port), seconds, int(stormers))
+    results = {
+        'reactor': _run(0, options.seconds, options.storm),
+        'pool': _run(options.threads, options.seconds, options.storm),
+    }
+    json.dump(results, options.output, indent=2, sort_keys=True)
+    options.output.write('\n')
+
+
+
+if __name__ == '__main__':
+    main()
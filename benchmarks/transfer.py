@@ -0,0 +1,168 @@
+"""
+Measure bulk transfer over connections made by L{SNIMap}.
+
+After an in-memory handshake, the server sends a payload to the client in
+chunks, through the same C{send}, C{bio_read}, C{bio_write} and C{recv}
+calls L{TLSMemoryBIOProtocol} makes.  The server connection is, in turn, a
+plain pyOpenSSL one from L{CertificateOptions}, one wrapped in the
+delegating proxy L{SNIMap} used to hand out, and the one it hands out now.
+
+Usage, from the root of a checkout::
+
+    PYTHONPATH=. python benchmarks/transfer.py [--megabytes N] \\
+        [--chunk BYTES] [--repeat N] [--output FILE]
+
+Results are written as JSON: for each connection, the median throughput in
+megabytes per second and the median time per chunk in microseconds.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+from OpenSSL.SSL import Connection, Context, SSLv23_METHOD, WantReadError
+
+from twisted.python.filepath import FilePath
+
+from txsni.snimap import HostDirectoryMap, SNIMap, _ContextProxy
+from txsni.test.certs.cert_builder import CERT_DIR, _build_certs
+
+
+class _ConnectionProxy(object):
+    """
+    The proxy L{SNIMap.serverConnectionForTLS} used to wrap connections in,
+    which delegated every call through C{__getattr__}.
+    """
+    def __init__(self, original, factory):
+        self._obj = original
+        self._factory = factory
+
+    def get_context(self):
+        ctx = self._obj.get_context()
+        return _ContextProxy(ctx, self._factory)
+
+    def __getattr__(self, attr):
+        return getattr(self._obj, attr)
+
+    def __setattr__(self, attr, val):
+        if attr in ('_obj', '_factory'):
+            self.__dict__[attr] = val
+        else:
+            setattr(self._obj, attr, val)
+
+    def __delattr__(self, attr):
+        return delattr(self._obj, attr)
+
+
+
+def _shuttle(server, client):
+    """
+    Move whatever C{server} has to send over to C{client}.
+    """
+    while True:
+        try:
+            data = server.bio_read(65536)
+        except WantReadError:
+            return
+        client.bio_write(data)
+
+
+
+def connect(server):
+    """
+    Complete a handshake between C{server} and a new client connection.
+
+    @return: the client connection.
+    """
+    server.set_accept_state()
+    client = Connection(Context(SSLv23_METHOD), None)
+    client.set_tlsext_host_name(b'http2bin.org')
+    client.set_connect_state()
+    done = set()
+    while len(done) < 2:
+        for name, source, destination in [('client', client, server),
+                                          ('server', server, client)]:
+            try:
+                source.do_handshake()
+            except WantReadError:
+                pass
+            else:
+                done.add(name)
+            _shuttle(source, destination)
+    return client
+
+
+
+def transfer(server, size, chunk):
+    """
+    Send C{size} bytes from C{server} to a client, C{chunk} bytes at a time.
+
+    @return: the number of seconds taken.
+    """
+    client = connect(server)
+    payload = b'x' * chunk
+    received = 0
+    before = time.perf_counter()
+    for _ in range(size // chunk):
+        server.send(payload)
+        _shuttle(server, client)
+        while True:
+            try:
+                received += len(client.recv(65536))
+            except WantReadError:
+                break
+    elapsed = time.perf_counter() - before
+    assert received == size // chunk * chunk
+    return elapsed
+
+
+
+def servers():
+    """
+    The server connections to measure, as (name, factory) pairs.
+    """
+    _build_certs()
+    sniMap = SNIMap(HostDirectoryMap(FilePath(CERT_DIR)))
+    options = sniMap.mapping['http2bin.org']
+
+    yield 'plain', lambda: Connection(options.getContext(), None)
+    yield 'proxy', lambda: _ConnectionProxy(
+        Connection(sniMap.context, None), sniMap
+    )
+    yield 'snimap', lambda: sniMap.serverConnectionForTLS(None)
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--megabytes', type=int, default=64,
+                        help='payload size per run')
+    parser.add_argument('--chunk', type=int, default=16384,
+                        help='bytes per send')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per connection')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='where to write the JSON')
+    options = parser.parse_args(argv)
+
+    size = options.megabytes * 1024 * 1024
+    chunks = size // options.chunk
+    results = {}
+    for name, makeServer in servers():
+        times = sorted(transfer(makeServer(), size, options.chunk)
+                       for _ in range(options.repeat))
+        median = times[len(times) // 2]
+        results[name] = {
+            'megabytes_per_second': options.megabytes / median,
+            'chunk_us': median / chunks * 1e6,
+        }
+    json.dump(results, options.output, indent=2, sort_keys=True)
+    options.output.write('\n')
+
+
+
+if __name__ == '__main__':
+    main()
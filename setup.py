@@ -18,9 +18,16 @@ setup(
         "twisted.plugins",
     ],
     install_requires=[
-        "Twisted[tls]>=14.0",
-        "pyOpenSSL>=0.14",
+        # BufferingTLSTransport, used by txsni.offload, is new in Twisted
+        # 23.10.  Twisted releases before 26 change contexts already in use,
+        # which pyOpenSSL refuses from 26.2 on, so they need pyOpenSSL 26.1.
+        "Twisted[tls]>=23.10.0",
+        "pyOpenSSL>=26.1.0",
+        # The OpenSSL functions txsni.settings and txsni.snimap call through
+        # pyOpenSSL's bindings are all there from cryptography 47.
+        "cryptography>=47.0.0",
     ],
+    python_requires=">=3.8",
     version="0.1.9",
     long_description=long_description,
     license="MIT",
@@ -33,8 +40,7 @@ setup(
         "Operating System :: POSIX",
         "Operating System :: POSIX :: Linux",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
         "Programming Language :: Python :: Implementation :: CPython",
         "Programming Language :: Python :: Implementation :: PyPy",
         "Topic :: Security :: Cryptography",
@@ -0,0 +1,23 @@
+"""
+Command line tools: C{python -m txsni <command> ...}.
+"""
+
+from __future__ import print_function
+
+import sys
+
+_USAGE = "usage: python -m txsni check <pemdir>"
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != "check":
+        print(_USAGE, file=sys.stderr)
+        return 2
+    from txsni.check import main as check
+    return check(argv[1:])
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
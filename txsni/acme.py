@@ -0,0 +1,111 @@
+"""
+ACME tls-alpn-01 challenge certificates, held in memory.
+
+An ACME client answering tls-alpn-01 challenges for many domains at once
+can hand each challenge certificate straight to a L{ChallengeStore} used as
+L{SNIMap}'s C{acme_mapping}, rather than writing a file for each to an
+C{acme} directory for L{HostDirectoryMap} to find and parse.
+"""
+
+from txsni.sanmap import normalizeHostname
+
+ACME_TLS_1 = b'acme-tls/1'
+
+
+class ChallengeStore(object):
+    """
+    A mapping of hostnames to the L{CertificateOptions} serving their
+    tls-alpn-01 challenge certificates, for L{SNIMap}'s C{acme_mapping}.
+
+    Each challenge's context is built when it is added, so handshakes never
+    wait for one, and is only ever used to answer challenges.  Challenges
+    are forgotten after C{ttl} seconds unless removed before then.
+
+    @ivar ttl: How many seconds challenges are kept for by default.
+    """
+    def __init__(self, ttl=300.0, clock=None):
+        self.ttl = ttl
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._challenges = {}
+
+
+    def __len__(self):
+        return len(self._challenges)
+
+
+    def __contains__(self, hostname):
+        return self.get(hostname) is not None
+
+
+    def __getitem__(self, hostname):
+        options = self.get(hostname)
+        if options is None:
+            raise KeyError("no challenge for %r" % (hostname,))
+        return options
+
+
+    def get(self, hostname, default=None):
+        """
+        Look up the challenge for C{hostname}.
+
+        @return: the options, or C{default} if there is no challenge for
+            C{hostname}.
+        """
+        if hostname is None:
+            return default
+        try:
+            hostname = normalizeHostname(hostname)
+        except UnicodeError:
+            return default
+        challenge = self._challenges.get(hostname)
+        if challenge is None:
+            return default
+        return challenge[0]
+
+
+    def add(self, hostname, options, ttl=None):
+        """
+        Serve a challenge certificate for C{hostname}, replacing any already
+        served.
+
+        @param options: The options serving the challenge certificate, which
+            must not be used for anything else.
+        @type options: L{CertificateOptions}
+
+        @param ttl: How many seconds to keep the challenge for, if not
+            C{self.ttl}.
+        """
+        hostname = normalizeHostname(hostname)
+        options.getContext()
+        self.remove(hostname)
+        expiry = self._clock.callLater(self.ttl if ttl is None else ttl,
+                                       self._expire, hostname)
+        self._challenges[hostname] = (options, expiry)
+
+
+    def remove(self, hostname):
+        """
+        Stop serving the challenge for C{hostname}.
+
+        @return: whether there was one.
+        """
+        challenge = self._challenges.pop(normalizeHostname(hostname), None)
+        if challenge is None:
+            return False
+        challenge[1].cancel()
+        return True
+
+
+    def clear(self):
+        """
+        Stop serving every challenge.
+        """
+        for _, expiry in self._challenges.values():
+            expiry.cancel()
+        self._challenges.clear()
+
+
+    def _expire(self, hostname):
+        del self._challenges[hostname]
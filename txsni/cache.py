@@ -0,0 +1,215 @@
+"""
+A two-tier, memory-budgeted cache of the options of many hosts.
+"""
+
+import collections
+import time
+
+from OpenSSL.crypto import FILETYPE_ASN1, dump_certificate
+
+from txsni.only_noticed_pypi_pem_after_i_wrote_this import (
+    Interner, _encodeOptions, _optionsFromDER,
+)
+
+# Rough costs, measured with 2048 bit RSA keys: a built context and the
+# objects parsed for it take about 16KiB plus four times the size of the
+# DER they were parsed from; an encoded entry takes its DER plus the Python
+# objects holding it.
+_CONTEXT_OVERHEAD = 16384
+_PARSED_FACTOR = 4
+_ENCODED_OVERHEAD = 256
+
+
+class TieredCache(object):
+    """
+    Cached options for many hosts, in two tiers with a byte budget each.
+
+    The hot tier holds L{CertificateOptions} with their contexts built, for
+    the hosts seen most recently; the warm tier holds just the DER encoded
+    keys and certificates, from which a host's options are rebuilt, without
+    touching its source, when it comes back.  Each tier evicts its least
+    recently used entries when it is over budget, and the hot tier also
+    drops entries idle for longer than C{idleTimeout} seconds.  Entries
+    evicted from the hot tier stay in the warm one, if it has room.
+
+    Sizes are estimates, from the length of each entry's DER encoding.
+
+    Each entry has a tag, such as the identity of the file it was loaded
+    from, that is returned along with its options.
+
+    @ivar contextBudget: The estimated bytes the hot tier may use, or
+        L{None} for no limit.
+    @ivar encodedBudget: The bytes the warm tier may use; C{0} turns it off.
+    @ivar idleTimeout: The seconds after which unused hot entries are
+        dropped, or L{None} to keep them until they are crowded out.
+    @ivar hotHits: The number of lookups answered from the hot tier.
+    @ivar warmHits: The number of lookups whose options were rebuilt from
+        the warm tier.
+    """
+    def __init__(self, contextBudget=None, encodedBudget=0,
+                 idleTimeout=None, clock=None, interner=None):
+        self.contextBudget = contextBudget
+        self.encodedBudget = encodedBudget
+        self.idleTimeout = idleTimeout
+        self._now = time.time if clock is None else clock.seconds
+        self.interner = Interner() if interner is None else interner
+        # Both are kept in order of use, least recent first.
+        self._hot = collections.OrderedDict()
+        self._warm = collections.OrderedDict()
+        self.contextBytes = 0
+        self.encodedBytes = 0
+        self.hotHits = 0
+        self.warmHits = 0
+
+
+    def __len__(self):
+        return len(self._hot) + sum(1 for key in self._warm
+                                    if key not in self._hot)
+
+
+    def __contains__(self, key):
+        return key in self._hot or key in self._warm
+
+
+    def __iter__(self):
+        for key in self._hot:
+            yield key
+        for key in self._warm:
+            if key not in self._hot:
+                yield key
+
+
+    def get(self, key):
+        """
+        Look up C{key}.
+
+        @return: a tuple of its tag and its options, or L{None}.
+        """
+        now = self._now()
+        self._expireIdle(now)
+        entry = self._hot.get(key)
+        if entry is not None:
+            self.hotHits += 1
+            self._hot.move_to_end(key)
+            tag, options, size, _ = entry
+            self._hot[key] = (tag, options, size, now)
+            return tag, options
+        encoded = self._warm.get(key)
+        if encoded is None:
+            return None
+        self.warmHits += 1
+        self._warm.move_to_end(key)
+        tag, keys, certificates, _ = encoded
+        options = _optionsFromDER(self.interner, keys, certificates)
+        self._addHot(key, tag, options, _derSize(keys, certificates), now)
+        return tag, options
+
+
+    def put(self, key, tag, options, encoded=None):
+        """
+        Cache the options for C{key}, replacing any already cached.
+
+        @param encoded: The DER encoded keys and certificates of C{options},
+            as returned by L{_encodeOptions}, if the caller has them already.
+        """
+        self.pop(key)
+        if self.encodedBudget:
+            if encoded is None:
+                encoded = _encodeOptions(options)
+            keys, certificates = encoded
+            derSize = _derSize(keys, certificates)
+            size = derSize + _ENCODED_OVERHEAD
+            self._warm[key] = (tag, keys, certificates, size)
+            self.encodedBytes += size
+            while self.encodedBytes > self.encodedBudget:
+                self.encodedBytes -= self._warm.popitem(last=False)[1][3]
+        elif encoded is not None:
+            derSize = _derSize(*encoded)
+        else:
+            derSize = _estimateDERSize(options)
+        self._addHot(key, tag, options, derSize, self._now())
+
+
+    def _addHot(self, key, tag, options, derSize, now):
+        size = _CONTEXT_OVERHEAD + derSize * _PARSED_FACTOR
+        self._hot[key] = (tag, options, size, now)
+        self.contextBytes += size
+        if self.contextBudget is not None:
+            # The entry just added stays, even if it alone is over budget.
+            while (self.contextBytes > self.contextBudget
+                   and len(self._hot) > 1):
+                self.contextBytes -= self._hot.popitem(last=False)[1][2]
+
+
+    def _expireIdle(self, now):
+        if self.idleTimeout is None:
+            return
+        cutoff = now - self.idleTimeout
+        hot = self._hot
+        while hot:
+            key = next(iter(hot))
+            if hot[key][3] > cutoff:
+                break
+            self.contextBytes -= hot.pop(key)[2]
+
+
+    def expireIdle(self):
+        """
+        Drop the hot entries idle for longer than C{idleTimeout}, as every
+        lookup also does.
+        """
+        self._expireIdle(self._now())
+
+
+    def pop(self, key):
+        """
+        Forget C{key}, if it is cached.
+        """
+        entry = self._hot.pop(key, None)
+        if entry is not None:
+            self.contextBytes -= entry[2]
+        encoded = self._warm.pop(key, None)
+        if encoded is not None:
+            self.encodedBytes -= encoded[3]
+
+
+    def clear(self):
+        """
+        Forget everything.
+        """
+        self._hot.clear()
+        self._warm.clear()
+        self.contextBytes = 0
+        self.encodedBytes = 0
+
+
+    def memoryUsage(self):
+        """
+        The estimated bytes used by each tier.
+
+        @return: a L{dict} with the bytes used by the C{"contexts"} and the
+            C{"encoded"} tiers.
+        """
+        return {"contexts": self.contextBytes, "encoded": self.encodedBytes}
+
+
+
+def _derSize(keys, certificates):
+    return sum(len(blob) for blob in keys) + sum(len(blob)
+                                                 for blob in certificates)
+
+
+
+def _estimateDERSize(options):
+    """
+    Estimate the size of the DER encoding of C{options} without encoding
+    its private keys, which is slow.
+    """
+    pairs = [(options.certificate, options.privateKey)]
+    pairs.extend(getattr(options, 'additionalCertificates', ()))
+    certificates = ([certificate for certificate, _ in pairs]
+                    + list(options.extraCertChain))
+    # A private key's DER takes about five bytes per byte of its size.
+    return (sum(privateKey.bits() // 8 * 5 for _, privateKey in pairs)
+            + sum(len(dump_certificate(FILETYPE_ASN1, certificate))
+                  for certificate in certificates))
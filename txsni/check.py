@@ -0,0 +1,302 @@
+"""
+Check a L{HostDirectoryMap}-style directory before serving it.
+
+Run it with::
+
+    python -m txsni check [--processes N] [--problems] [--json] <pemdir>
+
+Every C{<hostname>.pem} file is loaded just as L{HostDirectoryMap} loads
+it, and its context built, spread over a pool of processes.  For each host
+it reports how long that took, the type and size of each key, the length of
+the chain, when the first certificate expires and whether the certificates
+cover the hostname.  The exit status is non-zero if any file fails to load,
+has expired or is not valid for its hostname, so it can gate deploys.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.python.filepath import FilePath
+
+from txsni.only_noticed_pypi_pem_after_i_wrote_this import (
+    certificateOptionsFromPileOfPEM, keyType,
+)
+from txsni.sanmap import (
+    HostnameIndex, dnsNamesForCertificate, normalizeHostname,
+)
+
+# Files are handed to the pool in batches of this many, so that tens of
+# thousands of small files do not cost a round trip each.
+_BATCH_SIZE = 64
+
+
+class HostReport(object):
+    """
+    What L{checkFile} found out about one host's file.
+
+    @ivar hostname: The hostname, from the file's name.
+    @ivar path: The path of the file.
+    @ivar parseTime: The seconds taken to load the file.
+    @ivar contextTime: The seconds taken to build its context.
+    @ivar error: Why the file could not be loaded, or L{None}.
+    @ivar certificates: For each key, a tuple of its type, its size in bits,
+        the L{datetime.datetime} its certificate expires at and the DNS
+        names the certificate covers.
+    @ivar chainLength: The number of chain certificates sent with them.
+    """
+    def __init__(self, hostname, path):
+        self.hostname = hostname
+        self.path = path
+        self.parseTime = 0.0
+        self.contextTime = 0.0
+        self.error = None
+        self.certificates = []
+        self.chainLength = 0
+
+
+    @property
+    def expires(self):
+        """
+        When the first of the host's certificates expires, or L{None} if it
+        has none.
+        """
+        if not self.certificates:
+            return None
+        return min(notAfter for _, _, notAfter, _ in self.certificates)
+
+
+    @property
+    def mismatches(self):
+        """
+        The types of the keys whose certificates do not cover the hostname.
+
+        The C{DEFAULT} host is served to clients asking for names with no
+        file of their own, so any names will do for it.
+        """
+        if self.hostname == u"DEFAULT":
+            return []
+        mismatches = []
+        for kind, _, _, names in self.certificates:
+            index = HostnameIndex()
+            for name in names:
+                try:
+                    index.add(name, True)
+                except UnicodeError:
+                    # Reported by unencodableNames.
+                    pass
+            if not index.get(self.hostname):
+                mismatches.append(kind)
+        return mismatches
+
+
+    @property
+    def unencodableNames(self):
+        """
+        The names the host's certificates cover that cannot be IDNA encoded,
+        such as those with overlong labels, and so are never matched.
+        """
+        unencodable = []
+        for _, _, _, names in self.certificates:
+            for name in names:
+                try:
+                    normalizeHostname(name)
+                except UnicodeError:
+                    if name not in unencodable:
+                        unencodable.append(name)
+        return unencodable
+
+
+    def problems(self, now, slowTime):
+        """
+        Describe what is wrong with the host.
+
+        @param now: The current time, as an aware L{datetime.datetime}.
+
+        @param slowTime: How many seconds loading a file and building its
+            context may take before it counts as slow.
+
+        @return: a L{list} of C{(fatal, description)} pairs, where C{fatal}
+            says whether the host cannot be served as it is.
+        """
+        if self.error is not None:
+            return [(True, self.error)]
+        problems = []
+        if self.expires <= now:
+            problems.append((True, "expired"))
+        for kind in self.mismatches:
+            problems.append((True, "%s certificate is not valid for %s"
+                             % (kind, self.hostname)))
+        for name in self.unencodableNames:
+            problems.append((False, "cannot encode name %s" % (name,)))
+        if self.parseTime + self.contextTime > slowTime:
+            problems.append((False, "slow to load"))
+        return problems
+
+
+    def asDict(self, now, slowTime):
+        """
+        Describe the host as a L{dict} that can be encoded as JSON.
+        """
+        return {
+            "hostname": self.hostname,
+            "path": self.path,
+            "parse_seconds": self.parseTime,
+            "context_seconds": self.contextTime,
+            "error": self.error,
+            "keys": ["%s-%d" % (kind, bits)
+                     for kind, bits, _, _ in self.certificates],
+            "chain_length": self.chainLength,
+            "expires": (None if self.expires is None
+                        else self.expires.isoformat()),
+            "names": sorted(set(name for _, _, _, names in self.certificates
+                                for name in names)),
+            "problems": [description for _, description
+                         in self.problems(now, slowTime)],
+        }
+
+
+
+def _notAfter(certificate):
+    notAfter = certificate.get_notAfter().decode("ascii")
+    return datetime.datetime.strptime(notAfter, "%Y%m%d%H%M%SZ").replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+
+def checkFile(path):
+    """
+    Load a host's file, as L{HostDirectoryMap} would, and build its
+    context.
+
+    @param path: The path of the file, which is named for its host.
+    @type path: L{str}
+
+    @return: a L{HostReport}.
+    """
+    filePath = FilePath(path)
+    report = HostReport(filePath.basename()[:-len(".pem")], path)
+    before = time.perf_counter()
+    try:
+        options = certificateOptionsFromPileOfPEM(filePath.getContent())
+        parsed = time.perf_counter()
+        options.getContext()
+    except Exception as e:
+        report.parseTime = time.perf_counter() - before
+        report.error = str(e) or e.__class__.__name__
+        return report
+    report.parseTime = parsed - before
+    report.contextTime = time.perf_counter() - parsed
+    pairs = [(options.certificate, options.privateKey)]
+    pairs.extend(getattr(options, "additionalCertificates", ()))
+    for certificate, privateKey in pairs:
+        report.certificates.append((keyType(privateKey), privateKey.bits(),
+                                    _notAfter(certificate),
+                                    dnsNamesForCertificate(certificate)))
+    report.chainLength = len(options.extraCertChain)
+    return report
+
+
+
+def _checkFiles(paths):
+    return [checkFile(path) for path in paths]
+
+
+
+def checkDirectory(directoryPath, processes=None):
+    """
+    Check every C{<hostname>.pem} file in a directory.
+
+    @param directoryPath: The directory.
+    @type directoryPath: L{FilePath}
+
+    @param processes: The number of processes to check files in, by
+        default one per CPU; C{0} checks them in this process.
+
+    @return: the L{HostReport}s of the files, sorted by path.
+    """
+    paths = sorted(filePath.path
+                   for filePath in directoryPath.globChildren("*.pem"))
+    batches = [paths[i:i + _BATCH_SIZE]
+               for i in range(0, len(paths), _BATCH_SIZE)]
+    if processes == 0:
+        results = map(_checkFiles, batches)
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_checkFiles, batches))
+    return [report for batch in results for report in batch]
+
+
+
+def _describe(report, problems):
+    if report.error is not None:
+        return "%s: error: %s" % (report.hostname, report.error)
+    fields = [
+        "%.1fms" % ((report.parseTime + report.contextTime) * 1000,),
+        ",".join("%s-%d" % (kind, bits)
+                 for kind, bits, _, _ in report.certificates),
+        "chain %d" % (report.chainLength,),
+        "expires %s" % (report.expires.date().isoformat(),),
+        "%d names" % (len(set(name for _, _, _, names in report.certificates
+                              for name in names)),),
+    ]
+    fields.extend(description for _, description in problems)
+    return "%s: %s" % (report.hostname, ", ".join(fields))
+
+
+
+def main(argv=None):
+    """
+    Check a directory of PEM files, printing a line per host.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m txsni check",
+        description="Check every certificate file in a directory.",
+    )
+    parser.add_argument("directory", help="the directory of PEM files")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="processes to check files in (default: one "
+                        "per CPU)")
+    parser.add_argument("--slow", type=float, default=50.0,
+                        help="milliseconds after which loading a file "
+                        "counts as slow (default: 50)")
+    parser.add_argument("--problems", action="store_true",
+                        help="only report hosts with problems")
+    parser.add_argument("--json", action="store_true",
+                        help="write a JSON list of hosts instead")
+    options = parser.parse_args(argv)
+
+    directoryPath = FilePath(options.directory)
+    if not directoryPath.isdir():
+        parser.error("%s is not a directory" % (options.directory,))
+    before = time.perf_counter()
+    reports = checkDirectory(directoryPath, options.processes)
+    elapsed = time.perf_counter() - before
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    slowTime = options.slow / 1000
+    failed = 0
+    described = []
+    for report in reports:
+        problems = report.problems(now, slowTime)
+        if any(fatal for fatal, _ in problems):
+            failed += 1
+        if problems or not options.problems:
+            described.append((report, problems))
+    if options.json:
+        json.dump([report.asDict(now, slowTime) for report, _ in described],
+                  sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        for report, problems in described:
+            print(_describe(report, problems))
+    print("checked %d hosts in %.1fs, %d failed"
+          % (len(reports), elapsed, failed), file=sys.stderr)
+    return 1 if failed else 0
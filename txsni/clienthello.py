@@ -0,0 +1,354 @@
+"""
+Resolve certificates asynchronously, before OpenSSL sees the handshake.
+
+OpenSSL asks for a host's context from inside the handshake, through a
+callback that has to answer at once, so L{SNIMap}'s mapping cannot wait for
+anything.  L{ClientHelloFactory} sits in front of a L{TLSMemoryBIOFactory}
+and holds each connection's first bytes back until it has read the whole
+ClientHello, parsed the server name and ALPN protocols out of it, and given
+a resolver - typically L{AsyncMapping.resolveClientHello} - the chance to
+look the certificate up, however long that takes.  Only then does the
+handshake begin, by which time the L{AsyncMapping} the L{SNIMap} reads from
+has the answer.
+"""
+
+import collections
+import struct
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.logger import Logger
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+
+from txsni.snimap import _isValidServerName
+
+_log = Logger()
+
+ClientHello = collections.namedtuple('ClientHello',
+                                     ['serverName', 'alpnProtocols'])
+
+_RECORD_HEADER = struct.Struct('!BBBH')
+_HANDSHAKE = 22
+_CLIENT_HELLO = 1
+_SERVER_NAME = 0
+_HOST_NAME = 0
+_ALPN = 16
+
+
+class _Reader(object):
+    """
+    Read the fields of a TLS message, raising L{ValueError} if it is
+    shorter than they say.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+
+    def take(self, length):
+        end = self.offset + length
+        if end > len(self.data):
+            raise ValueError("Truncated ClientHello")
+        value = self.data[self.offset:end]
+        self.offset = end
+        return value
+
+
+    def integer(self, size):
+        value = 0
+        for byte in bytearray(self.take(size)):
+            value = value << 8 | byte
+        return value
+
+
+    def vector(self, lengthSize):
+        return self.take(self.integer(lengthSize))
+
+
+    def remaining(self):
+        return self.offset < len(self.data)
+
+
+
+def parseClientHello(data):
+    """
+    Parse the ClientHello at the start of a TLS connection.
+
+    @param data: The bytes received so far.
+    @type data: L{bytes}
+
+    @return: a L{ClientHello} holding the server name, as L{bytes} or
+        L{None}, and the list of ALPN protocols offered, or L{None} if
+        C{data} does not hold the whole ClientHello yet.
+
+    @raise ValueError: if C{data} does not start with a ClientHello.
+    """
+    fragments = []
+    buffered = 0
+    offset = 0
+    while True:
+        if len(data) < offset + _RECORD_HEADER.size:
+            return None
+        contentType, major, _, length = _RECORD_HEADER.unpack_from(data,
+                                                                   offset)
+        if contentType != _HANDSHAKE or major != 3:
+            raise ValueError("Not a TLS handshake record")
+        offset += _RECORD_HEADER.size
+        if len(data) < offset + length:
+            return None
+        # A ClientHello may be split over several records.
+        fragments.append(data[offset:offset + length])
+        buffered += length
+        offset += length
+        if buffered >= 4:
+            handshake = b''.join(fragments)
+            header = _Reader(handshake)
+            if header.integer(1) != _CLIENT_HELLO:
+                raise ValueError("Not a ClientHello")
+            messageLength = header.integer(3)
+            if buffered >= 4 + messageLength:
+                return _parseClientHelloBody(header.take(messageLength))
+
+
+
+def _parseClientHelloBody(body):
+    reader = _Reader(body)
+    reader.take(2 + 32)  # client_version, random
+    reader.vector(1)  # legacy_session_id
+    reader.vector(2)  # cipher_suites
+    reader.vector(1)  # legacy_compression_methods
+    serverName = None
+    alpnProtocols = []
+    if not reader.remaining():
+        return ClientHello(serverName, alpnProtocols)
+    extensions = _Reader(reader.vector(2))
+    while extensions.remaining():
+        extensionType = extensions.integer(2)
+        extension = _Reader(extensions.vector(2))
+        if extensionType == _SERVER_NAME:
+            names = _Reader(extension.vector(2))
+            while names.remaining():
+                nameType = names.integer(1)
+                name = names.vector(2)
+                if nameType == _HOST_NAME:
+                    serverName = name
+        elif extensionType == _ALPN:
+            protocols = _Reader(extension.vector(2))
+            while protocols.remaining():
+                alpnProtocols.append(protocols.vector(1))
+    return ClientHello(serverName, alpnProtocols)
+
+
+
+class _ClientHelloProtocol(ProtocolWrapper):
+    """
+    Hold a connection's bytes back from the TLS protocol it wraps until its
+    ClientHello has been resolved, then pass everything through.
+    """
+    def __init__(self, factory, wrappedProtocol):
+        ProtocolWrapper.__init__(self, factory, wrappedProtocol)
+        self._buffer = []
+        self._resolving = False
+        self._passing = False
+        self._lost = False
+
+
+    def dataReceived(self, data):
+        if self._passing:
+            self.wrappedProtocol.dataReceived(data)
+            return
+        self._buffer.append(data)
+        if self._resolving:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = [data]
+        try:
+            hello = parseClientHello(data)
+        except ValueError:
+            # Let OpenSSL reject whatever this is.
+            self._passThrough()
+            return
+        if hello is None:
+            if len(data) > self.factory.maximumHelloSize:
+                self._passThrough()
+            return
+        self._resolving = True
+        d = maybeDeferred(self.factory.resolve, hello)
+        if self.factory.timeout is not None:
+            d.addTimeout(self.factory.timeout, self.factory.clock)
+        d.addErrback(lambda failure: _log.failure(
+            "Could not resolve {serverName!r}", failure,
+            serverName=hello.serverName,
+        ))
+        d.addCallback(lambda _: self._passThrough())
+
+
+    def _passThrough(self):
+        self._passing = True
+        data = b''.join(self._buffer)
+        self._buffer = None
+        if not self._lost:
+            self.wrappedProtocol.dataReceived(data)
+
+
+    def connectionLost(self, reason):
+        self._lost = True
+        ProtocolWrapper.connectionLost(self, reason)
+
+
+
+class ClientHelloFactory(WrappingFactory):
+    """
+    Wraps a L{TLSMemoryBIOFactory} so that each connection's ClientHello is
+    handed to C{resolve} before the TLS protocol sees it.
+
+    @ivar resolve: A callable taking a L{ClientHello} and returning a
+        L{Deferred} that fires once the certificate for it can be found
+        without waiting, or any other value if it already can.  Failures are
+        logged, and the handshake goes ahead regardless.
+    @ivar timeout: How many seconds to wait for C{resolve} before going
+        ahead with the handshake anyway, or L{None} to wait for as long as
+        it takes.
+    @ivar maximumHelloSize: How many bytes to buffer while waiting for the
+        end of a ClientHello before giving up and letting OpenSSL have them.
+    """
+    protocol = _ClientHelloProtocol
+    maximumHelloSize = 65536
+
+    def __init__(self, wrappedFactory, resolve, timeout=None, clock=None):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.resolve = resolve
+        self.timeout = timeout
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+
+
+
+class AsyncMapping(object):
+    """
+    A mapping for L{SNIMap} whose lookups may take time, such as queries of
+    a database or another service.
+
+    L{resolve} looks a host up with C{resolver} and remembers the answer for
+    C{ttl} seconds; L{get}, which L{SNIMap} calls during the handshake, only
+    ever answers from what has been remembered.  Put a L{ClientHelloFactory}
+    in front of the L{TLSMemoryBIOFactory}, with L{resolveClientHello} as
+    its resolver, to resolve each host before its handshake starts.
+
+    Concurrent lookups of the same host share one call of C{resolver}.
+    Invalid server names are never looked up.
+
+    @ivar resolver: A callable taking a server name, as L{bytes}, and
+        returning the L{CertificateOptions} for it, L{None} if there are
+        none, or a L{Deferred} that fires with either.
+    @ivar default: The options served to clients that send no server name,
+        or ask for one there are no options for.
+    """
+    def __init__(self, resolver, default=None, ttl=60.0, cacheSize=10000,
+                 clock=None):
+        self.resolver = resolver
+        self.default = default
+        self.ttl = ttl
+        self.maximumCacheSize = cacheSize
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+
+
+    def __getitem__(self, hostname):
+        options = self.get(hostname)
+        if options is None:
+            raise KeyError("no options resolved for %r" % (hostname,))
+        return options
+
+
+    def get(self, hostname, default=None):
+        """
+        Get the options already resolved for C{hostname}.
+
+        @return: the options, or C{default} if C{hostname} has not been
+            resolved, or has no options.
+        """
+        if hostname is None or hostname in (b'DEFAULT', u'DEFAULT'):
+            return self.default if self.default is not None else default
+        entry = self._cache.get(hostname)
+        if entry is None or entry[0] <= self._clock.seconds():
+            return default
+        return entry[1] if entry[1] is not None else default
+
+
+    def resolve(self, hostname):
+        """
+        Look C{hostname} up, unless it was looked up less than C{ttl}
+        seconds ago.
+
+        @param hostname: The server name, as L{bytes}, or L{None}.
+
+        @return: a L{Deferred} that fires with the options for C{hostname},
+            or L{None}, once L{get} can return them.
+        """
+        if hostname is None or not _isValidServerName(hostname):
+            return succeed(None)
+        entry = self._cache.get(hostname)
+        if entry is not None and entry[0] > self._clock.seconds():
+            return succeed(entry[1])
+        result = Deferred()
+        waiting = self._pending.get(hostname)
+        if waiting is not None:
+            waiting.append(result)
+            return result
+        # Wait before calling the resolver, which may answer at once.
+        self._pending[hostname] = [result]
+        d = maybeDeferred(self.resolver, hostname)
+        d.addErrback(self._failed, hostname)
+        d.addCallback(self._resolved, hostname)
+        return result
+
+
+    def resolveClientHello(self, hello):
+        """
+        Resolve the server name of a L{ClientHello}, for
+        L{ClientHelloFactory}.
+        """
+        return self.resolve(hello.serverName)
+
+
+    def _failed(self, failure, hostname):
+        _log.failure("Could not look up {hostname!r}", failure,
+                     hostname=hostname)
+        # Try again next time rather than remembering the failure.
+        for d in self._pending.pop(hostname):
+            d.callback(None)
+
+
+    def _resolved(self, options, hostname):
+        waiting = self._pending.pop(hostname, None)
+        if waiting is None:
+            return
+        self._cache.pop(hostname, None)
+        self._cache[hostname] = (self._clock.seconds() + self.ttl, options)
+        while len(self._cache) > self.maximumCacheSize:
+            self._cache.popitem(last=False)
+        for d in waiting:
+            d.callback(options)
+
+
+    @property
+    def cacheSize(self):
+        """
+        The number of hosts whose answers are remembered.
+        """
+        return len(self._cache)
+
+
+    def invalidate(self, hostname=None):
+        """
+        Forget the answer for C{hostname}, or for every host if it is
+        L{None}.
+        """
+        if hostname is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(hostname, None)
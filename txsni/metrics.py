@@ -0,0 +1,140 @@
+"""
+Counters describing what an L{SNIMap} spends its handshakes on.
+"""
+
+import collections
+
+from twisted.logger import Logger
+
+_log = Logger()
+
+# The name under which handshakes for hosts beyond the table's limit are
+# counted; no valid server name looks like it.
+OTHER_HOSTS = b"(other)"
+
+
+class SNIMetrics(object):
+    """
+    Handshake counters and timings for an L{SNIMap}.
+
+    Handshakes are counted per host only for names the mapping has a
+    certificate for; the rest are counted as fallbacks to the default
+    certificate.  A mapping with wildcards has a certificate for endless
+    names, though, so names are counted lower-cased and without a trailing
+    dot, and only the first C{maxHosts} of them are counted apart; the rest
+    are counted together as L{OTHER_HOSTS}.
+
+    @ivar handshakes: The number of handshakes that selected a context.
+    @ivar handshakesByHost: The number of handshakes per host name, as
+        L{bytes}; handshakes without a server name are counted as
+        C{b"DEFAULT"}.
+    @ivar maxHosts: The most host names counted in C{handshakesByHost}.
+    @ivar defaultFallbacks: The number of handshakes served the default
+        certificate because their server name was invalid or unknown.
+    @ivar acmeChallenges: The number of ACME tls-alpn-01 challenge
+        handshakes answered.
+    @ivar lookupSeconds: The total time spent looking server names up in the
+        mapping.
+    @ivar contextSeconds: The total time spent getting (and, the first time,
+        building) contexts from the options the mapping returned.
+    @ivar resumed: The number of completed handshakes that resumed a
+        session.
+    @ivar full: The number of completed full handshakes.
+    @ivar handshakesByKeyType: The number of completed handshakes per type
+        of key of the certificate served, such as C{"ECDSA"} or C{"RSA"}.
+    """
+    def __init__(self, maxHosts=1000):
+        self.handshakes = 0
+        self.handshakesByHost = collections.Counter()
+        self.maxHosts = maxHosts
+        self.defaultFallbacks = 0
+        self.acmeChallenges = 0
+        self.lookupSeconds = 0.0
+        self.contextSeconds = 0.0
+        self.resumed = 0
+        self.full = 0
+        self.handshakesByKeyType = collections.Counter()
+
+
+    def countHandshake(self, hostname):
+        """
+        Count a handshake for C{hostname}, or for C{b"DEFAULT"} if it is
+        L{None}.
+        """
+        self.handshakes += 1
+        if hostname is None:
+            hostname = b"DEFAULT"
+        else:
+            hostname = hostname.lower().rstrip(b".")
+        if (hostname not in self.handshakesByHost and
+                len(self.handshakesByHost) >= self.maxHosts):
+            hostname = OTHER_HOSTS
+        self.handshakesByHost[hostname] += 1
+
+
+    def snapshot(self, sniMap=None):
+        """
+        Gather the current values of these metrics, plus the size and
+        estimated memory use of the cache of C{sniMap}'s mapping if it has
+        one.
+
+        @return: a L{dict} of metric names to values.
+        """
+        snapshot = {
+            "handshakes": self.handshakes,
+            "handshakes_by_host": dict(
+                (host.decode("ascii"), count)
+                for host, count in self.handshakesByHost.items()
+            ),
+            "default_fallbacks": self.defaultFallbacks,
+            "acme_challenges": self.acmeChallenges,
+            "lookup_seconds": self.lookupSeconds,
+            "context_seconds": self.contextSeconds,
+            "resumed_handshakes": self.resumed,
+            "full_handshakes": self.full,
+            "handshakes_by_key_type": dict(self.handshakesByKeyType),
+        }
+        if sniMap is not None:
+            snapshot["rejected_names"] = sniMap.rejectedNames
+            snapshot["unknown_names"] = sniMap.unknownNames
+            cacheSize = getattr(sniMap.mapping, "cacheSize", None)
+            if cacheSize is not None:
+                snapshot["context_cache_size"] = cacheSize
+            memoryUsage = getattr(sniMap.mapping, "memoryUsage", None)
+            if memoryUsage is not None:
+                usage = memoryUsage()
+                snapshot["context_cache_bytes"] = usage["contexts"]
+                snapshot["encoded_cache_bytes"] = usage["encoded"]
+        return snapshot
+
+
+    def prometheusText(self, sniMap=None):
+        """
+        Render a L{snapshot} in the Prometheus text exposition format.
+
+        @rtype: L{str}
+        """
+        snapshot = self.snapshot(sniMap)
+        lines = []
+        for name, value in sorted(snapshot.items()):
+            if name in ("handshakes_by_host", "handshakes_by_key_type"):
+                continue
+            lines.append("txsni_%s %s" % (name, value))
+        for host, count in sorted(snapshot["handshakes_by_host"].items()):
+            lines.append('txsni_host_handshakes{host="%s"} %d'
+                         % (host.replace("\\", "\\\\").replace('"', '\\"'),
+                            count))
+        for keyType, count in sorted(
+                snapshot["handshakes_by_key_type"].items()):
+            lines.append('txsni_key_type_handshakes{key_type="%s"} %d'
+                         % (keyType, count))
+        return "\n".join(lines) + "\n"
+
+
+    def log(self, sniMap=None, logger=_log):
+        """
+        Emit a L{snapshot} as a L{twisted.logger} event.
+        """
+        logger.info("txsni metrics: {handshakes} handshakes, "
+                    "{default_fallbacks} default fallbacks",
+                    **self.snapshot(sniMap))
@@ -0,0 +1,321 @@
+"""
+OCSP stapling for the contexts an L{SNIMap} hands out.
+
+Responses are only ever fetched in the background, and handshakes are only
+ever served from the in-memory cache, so a slow or unavailable responder
+never delays a handshake; at worst the response is not stapled.
+"""
+
+import calendar
+import weakref
+
+from io import BytesIO
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import AuthorityInformationAccessOID
+
+from twisted.internet.defer import maybeDeferred
+from twisted.logger import Logger
+from twisted.web.client import FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+_log = Logger()
+
+
+def _timestamp(response, name):
+    """
+    Get one of the times in an OCSP response as a POSIX timestamp, or
+    L{None} if it is not set.
+    """
+    # Newer versions of cryptography deprecate the naive datetime attributes
+    # in favour of timezone-aware *_utc ones.
+    value = getattr(response, name + "_utc", None)
+    if value is None:
+        value = getattr(response, name)
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple())
+
+
+
+def _issuerOf(certificate, chain):
+    """
+    Find the certificate in C{chain} that issued C{certificate}.
+
+    @type certificate: L{x509.Certificate}
+    @type chain: L{list} of L{x509.Certificate}
+
+    @return: the issuer, or L{None}.
+    """
+    for candidate in chain:
+        if candidate.subject == certificate.issuer:
+            return candidate
+    return None
+
+
+
+def _checkMatches(response, certificate, issuer):
+    """
+    Check that the OCSP C{response} is about C{certificate}, as issued by
+    C{issuer}.
+
+    @raise ValueError: if it is not.
+    """
+    request = ocsp.OCSPRequestBuilder().add_certificate(
+        certificate, issuer, response.hash_algorithm
+    ).build()
+    if ((response.serial_number, response.issuer_name_hash,
+         response.issuer_key_hash) !=
+            (request.serial_number, request.issuer_name_hash,
+             request.issuer_key_hash)):
+        raise ValueError("OCSP response is for another certificate")
+
+
+
+class HTTPOCSPFetcher(object):
+    """
+    Fetch OCSP responses over HTTP from the responder named in each
+    certificate's authority information access extension.
+
+    @ivar timeout: The seconds after which a request is given up on.
+    """
+    def __init__(self, agent, reactor, timeout=30):
+        """
+        @param agent: The agent to make requests with.
+        @type agent: L{twisted.web.iweb.IAgent}
+        """
+        self.agent = agent
+        self.timeout = timeout
+        self._reactor = reactor
+
+
+    def __call__(self, certificate, issuer):
+        """
+        Fetch an OCSP response for C{certificate}.
+
+        @type certificate: L{x509.Certificate}
+        @type issuer: L{x509.Certificate}
+
+        @return: a L{Deferred} that fires with the DER encoded response.
+        """
+        access = certificate.extensions.get_extension_for_class(
+            x509.AuthorityInformationAccess
+        ).value
+        urls = [description.access_location.value
+                for description in access
+                if description.access_method ==
+                AuthorityInformationAccessOID.OCSP]
+        if not urls:
+            raise ValueError("Certificate names no OCSP responder")
+        request = ocsp.OCSPRequestBuilder().add_certificate(
+            certificate, issuer, hashes.SHA1()
+        ).build().public_bytes(serialization.Encoding.DER)
+        d = self.agent.request(
+            b"POST", urls[0].encode("ascii"),
+            Headers({b"Content-Type": [b"application/ocsp-request"]}),
+            FileBodyProducer(BytesIO(request)),
+        )
+        d.addCallback(readBody)
+        return d.addTimeout(self.timeout, self._reactor)
+
+
+
+class OCSPStapler(object):
+    """
+    Staples cached OCSP responses to handshakes, and keeps them fresh.
+
+    Each certificate's response is fetched in the background as soon as its
+    context is configured, and fetched again halfway between then and the
+    response's C{nextUpdate}; responses without a C{nextUpdate} are
+    refreshed every C{refreshInterval} seconds.  Failed fetches are retried
+    every C{retryInterval} seconds, while the previous response is stapled
+    until it expires.  Responses are only stored if they are about the
+    certificate they were fetched for, and never stapled past their
+    C{nextUpdate}.
+
+    Once no context stapling a certificate's response is left, the
+    certificate is forgotten at its next refresh.
+
+    @ivar fetcher: A callable taking a certificate and its issuer (both
+        L{x509.Certificate}s) and returning the DER encoded OCSP response for
+        the certificate, or a L{Deferred} that fires with it.  See
+        L{HTTPOCSPFetcher}.
+    @ivar cacheDirectory: An optional L{FilePath} in which responses are
+        kept, so they survive restarts.
+    """
+    def __init__(self, fetcher, reactor, cacheDirectory=None,
+                 refreshInterval=3600, retryInterval=300):
+        self.fetcher = fetcher
+        self.cacheDirectory = cacheDirectory
+        self.refreshInterval = refreshInterval
+        self.retryInterval = retryInterval
+        self._reactor = reactor
+        self._certificates = {}
+        self._responses = {}
+        self._expiries = {}
+        self._refreshes = {}
+        self._users = {}
+
+
+    def configure(self, context, options):
+        """
+        Staple OCSP responses for the certificates of C{options}, including
+        any additional ones, on C{context}, which must not have been used for
+        a connection yet.
+
+        @type context: L{OpenSSL.SSL.Context}
+        @type options: L{CertificateOptions}
+        """
+        if options.certificate is None:
+            return
+        certificates = [options.certificate] + [
+            certificate for certificate, _ in
+            getattr(options, 'additionalCertificates', ())
+        ]
+        chain = [extra.to_cryptography() for extra in options.extraCertChain]
+        keys = [self._watch(context, certificate.to_cryptography(), chain)
+                for certificate in certificates]
+        if len(keys) == 1:
+            context.set_ocsp_server_callback(self._staple, keys[0])
+        else:
+            # Which certificate is served is only known once the handshake
+            # has chosen one.
+            context.set_ocsp_server_callback(self._stapleChosen)
+
+
+    def _watch(self, context, certificate, chain):
+        """
+        Start keeping a response for C{certificate} fresh for C{context},
+        unless that is already being done.
+
+        @return: the key its response is cached under.
+        """
+        key = certificate.fingerprint(hashes.SHA256())
+        if key not in self._certificates:
+            issuer = _issuerOf(certificate, chain)
+            if issuer is None:
+                _log.warn("No issuer for {subject}, not stapling",
+                          subject=certificate.subject.rfc4514_string())
+                return key
+            self._certificates[key] = (certificate, issuer)
+            self._users[key] = weakref.WeakSet()
+            self._loadCached(key)
+            self._refreshes[key] = self._reactor.callLater(
+                0, self._refresh, key)
+        self._users[key].add(context)
+        return key
+
+
+    def _forget(self, key):
+        """
+        Stop keeping a response for the certificate cached under C{key}.
+        """
+        for table in (self._certificates, self._responses, self._expiries,
+                      self._users):
+            table.pop(key, None)
+        call = self._refreshes.pop(key, None)
+        if call is not None and call.active():
+            call.cancel()
+
+
+    def stop(self):
+        """
+        Stop refreshing responses.  Those already cached are still stapled
+        until they are replaced by new ones.
+        """
+        for call in self._refreshes.values():
+            if call.active():
+                call.cancel()
+        self._refreshes.clear()
+
+
+    def _staple(self, connection, key):
+        expires = self._expiries.get(key)
+        if expires is not None and expires <= self._reactor.seconds():
+            return b""
+        return self._responses.get(key, b"")
+
+
+    def _stapleChosen(self, connection, data):
+        certificate = connection.get_certificate().to_cryptography()
+        return self._staple(connection, certificate.fingerprint(hashes.SHA256()))
+
+
+    def _cacheFile(self, key):
+        return self.cacheDirectory.child(
+            ''.join('%02x' % (byte,) for byte in bytearray(key)) + '.ocsp'
+        )
+
+
+    def _loadCached(self, key):
+        if self.cacheDirectory is None:
+            return
+        cacheFile = self._cacheFile(key)
+        if cacheFile.isfile():
+            try:
+                self._store(key, cacheFile.getContent())
+            except ValueError as e:
+                _log.info("Ignoring cached OCSP response {path}: {error}",
+                          path=cacheFile.path, error=e)
+
+
+    def _store(self, key, der):
+        """
+        Check and cache the DER encoded OCSP response C{der}.
+
+        @return: the time at which to refresh it.
+
+        @raise ValueError: if the response is not a successful one about
+            the certificate cached under C{key}.
+        """
+        response = ocsp.load_der_ocsp_response(der)
+        if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+            raise ValueError("OCSP response status %s"
+                             % (response.response_status,))
+        _checkMatches(response, *self._certificates[key])
+        now = self._reactor.seconds()
+        nextUpdate = _timestamp(response, "next_update")
+        if nextUpdate is not None and nextUpdate <= now:
+            raise ValueError("OCSP response has expired")
+        self._responses[key] = der
+        self._expiries[key] = nextUpdate
+        if nextUpdate is None:
+            return now + self.refreshInterval
+        return now + (nextUpdate - now) / 2
+
+
+    def _refresh(self, key):
+        if not self._users[key]:
+            self._forget(key)
+            return None
+        certificate, issuer = self._certificates[key]
+
+        def fetched(der):
+            refreshAt = self._store(key, der)
+            if self.cacheDirectory is not None:
+                self._cacheFile(key).setContent(der)
+            return refreshAt
+
+        def failed(failure):
+            _log.failure("Could not fetch an OCSP response for {subject}",
+                         failure, subject=certificate.subject.rfc4514_string())
+            expires = self._expiries.get(key)
+            if expires is not None and expires <= self._reactor.seconds():
+                del self._responses[key]
+                del self._expiries[key]
+            return self._reactor.seconds() + self.retryInterval
+
+        def reschedule(refreshAt):
+            if key in self._refreshes:
+                self._refreshes[key] = self._reactor.callLater(
+                    max(refreshAt - self._reactor.seconds(), 0),
+                    self._refresh, key
+                )
+
+        d = maybeDeferred(self.fetcher, certificate, issuer)
+        d.addCallback(fetched)
+        d.addErrback(failed)
+        d.addCallback(reschedule)
+        return d
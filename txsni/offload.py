@@ -0,0 +1,272 @@
+"""
+Run TLS handshakes in a pool of threads rather than the reactor thread.
+
+Every private key operation of a handshake happens inside OpenSSL, which
+runs without the GIL, so a burst of new connections can be spread over
+several cores while the reactor carries on moving data for the connections
+already established.  L{OffloadingTLSFactory} is a L{TLSMemoryBIOFactory}
+whose connections hand each step of their handshake - the bytes received,
+and the C{do_handshake} call they allow - to a L{HandshakePool}, and go
+back to the usual, reactor-bound L{TLSMemoryBIOProtocol} behaviour once the
+handshake is done.
+
+The callbacks OpenSSL makes during a handshake are Python code, and the
+ones L{SNIMap} sets change its state and its mapping's, which is otherwise
+only ever touched from the reactor thread.  So they are wrapped in
+L{inReactor}, and when a handshake step running in the pool makes them,
+they run in the reactor thread while the pool thread waits.
+"""
+
+import os
+import threading
+
+from functools import wraps
+
+from OpenSSL.SSL import Error, WantReadError
+
+from twisted.internet.interfaces import IHandshakeListener
+from twisted.internet.threads import deferToThreadPool
+from twisted.protocols.tls import BufferingTLSTransport, TLSMemoryBIOFactory
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+# The pool, if any, whose handshake step the current thread is running.
+_running = threading.local()
+
+
+class HandshakePoolStopped(Exception):
+    """
+    The L{HandshakePool} was stopped while a handshake was waiting on the
+    reactor.
+    """
+
+
+
+class HandshakePool(object):
+    """
+    A bounded pool of threads for the handshakes of L{OffloadingTLSFactory}
+    connections.
+
+    The pool starts with the first endpoint listening through it, and is
+    stopped when the reactor shuts down.
+
+    @ivar size: The most handshake steps run at once.
+    """
+    def __init__(self, reactor, size=None):
+        """
+        @param size: The number of threads, by default one per CPU.
+        """
+        self.reactor = reactor
+        self.size = size or os.cpu_count() or 1
+        self._threadPool = ThreadPool(0, self.size, name="txsni-handshakes")
+        self._lock = threading.Lock()
+        self._waiting = set()
+        self._stopped = False
+        self._shutdownTrigger = None
+
+
+    def start(self):
+        """
+        Start the threads, unless they have been started already.
+        """
+        if self._threadPool.started:
+            return
+        self._threadPool.start()
+        self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+            "before", "shutdown", self.stop)
+
+
+    def stop(self):
+        """
+        Stop the threads, failing any handshakes waiting on the reactor so
+        that they cannot keep the pool from stopping.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            waiting = list(self._waiting)
+        if self._shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        for waiter in waiting:
+            waiter.set()
+        self._threadPool.stop()
+
+
+    def handshake(self, connection, data):
+        """
+        Feed C{data} to C{connection} and take its handshake as far as it
+        goes, in a pool thread.
+
+        @return: a L{Deferred} firing with whether the handshake is done.
+        """
+        return deferToThreadPool(self.reactor, self._threadPool,
+                                 self._handshake, connection, data)
+
+
+    def _handshake(self, connection, data):
+        _running.pool = self
+        try:
+            if data:
+                connection.bio_write(data)
+            try:
+                connection.do_handshake()
+            except WantReadError:
+                return False
+            return True
+        finally:
+            _running.pool = None
+
+
+    def _callInReactor(self, f, args):
+        """
+        Call C{f} in the reactor thread and wait for its result.
+        """
+        waiter = threading.Event()
+        result = []
+
+        def call():
+            try:
+                result.append((True, f(*args)))
+            except BaseException:
+                result.append((False, Failure()))
+            waiter.set()
+
+        with self._lock:
+            if self._stopped:
+                raise HandshakePoolStopped()
+            self._waiting.add(waiter)
+        try:
+            self.reactor.callFromThread(call)
+            waiter.wait()
+        finally:
+            with self._lock:
+                self._waiting.discard(waiter)
+        if not result:
+            raise HandshakePoolStopped()
+        succeeded, value = result[0]
+        if not succeeded:
+            value.raiseException()
+        return value
+
+
+
+def inReactor(f):
+    """
+    Wrap C{f}, an OpenSSL callback, so that when a L{HandshakePool} thread
+    makes it, it is run in the reactor thread instead.  Elsewhere, it is
+    called as it is.
+    """
+    @wraps(f)
+    def wrapper(*args):
+        pool = getattr(_running, "pool", None)
+        if pool is None:
+            return f(*args)
+        return pool._callInReactor(f, args)
+    return wrapper
+
+
+
+class _OffloadingTLSProtocol(BufferingTLSTransport):
+    """
+    A L{TLSMemoryBIOProtocol} that runs its handshake in its factory's
+    L{HandshakePool}.
+
+    While a step of the handshake is running in the pool, nothing else may
+    touch the OpenSSL connection, so bytes received are held back, and
+    shutting TLS down or handling the loss of the connection are put off,
+    until it has finished.
+    """
+    _stepping = False
+    _shutdownPending = False
+    _lostReason = None
+
+    def makeConnection(self, transport):
+        self._received = []
+        BufferingTLSTransport.makeConnection(self, transport)
+
+
+    def dataReceived(self, data):
+        if self._handshakeDone:
+            BufferingTLSTransport.dataReceived(self, data)
+            return
+        if self._lostTLSConnection or self._aborted:
+            return
+        self._received.append(data)
+        if not self._stepping:
+            self._step()
+
+
+    def _step(self):
+        data = b"".join(self._received)
+        del self._received[:]
+        self._stepping = True
+        d = self.factory.handshakePool.handshake(self._tlsConnection, data)
+        d.addBoth(self._stepped)
+
+
+    def _stepped(self, result):
+        self._stepping = False
+        if self._lostReason is not None:
+            reason, self._lostReason = self._lostReason, None
+            self.connectionLost(reason)
+            return
+        if self._shutdownPending:
+            self._shutdownPending = False
+            self._shutdownTLS()
+            return
+        if self._aborted:
+            return
+        if isinstance(result, Failure):
+            if not result.check(Error):
+                # Not an OpenSSL error, which is all _tlsShutdownFinished
+                # knows how to look at; report it as it is.
+                self._reason = result
+                result = None
+            self._tlsShutdownFinished(result)
+            return
+        if not result:
+            self._flushSendBIO()
+            if self._received:
+                self._step()
+            return
+        self._handshakeDone = True
+        if IHandshakeListener.providedBy(self.wrappedProtocol):
+            self.wrappedProtocol.handshakeCompleted()
+        if self._received:
+            data = b"".join(self._received)
+            del self._received[:]
+            self._tlsConnection.bio_write(data)
+        if self._appSendBuffer:
+            self._unbufferPendingWrites()
+        self._flushReceiveBIO()
+
+
+    def _shutdownTLS(self):
+        if self._stepping:
+            self._shutdownPending = True
+            return
+        BufferingTLSTransport._shutdownTLS(self)
+
+
+    def connectionLost(self, reason):
+        if self._stepping:
+            self._lostReason = reason
+            return
+        BufferingTLSTransport.connectionLost(self, reason)
+
+
+
+class OffloadingTLSFactory(TLSMemoryBIOFactory):
+    """
+    A L{TLSMemoryBIOFactory} whose connections run their handshakes in
+    C{handshakePool}, a L{HandshakePool}.
+    """
+    protocol = _OffloadingTLSProtocol
+
+    def __init__(self, contextFactory, isClient, wrappedFactory,
+                 handshakePool):
+        TLSMemoryBIOFactory.__init__(self, contextFactory, isClient,
+                                     wrappedFactory)
+        self.handshakePool = handshakePool
@@ -1,53 +1,342 @@
+import hashlib
+import warnings
+import weakref
 
-from OpenSSL.SSL import FILETYPE_PEM
+from functools import partial
+
+from OpenSSL.crypto import (
+    FILETYPE_ASN1, FILETYPE_PEM, TYPE_DSA, TYPE_EC, TYPE_RSA,
+    dump_certificate, dump_publickey, load_certificate, load_privatekey,
+)
 
 from twisted.internet.ssl import Certificate, KeyPair, CertificateOptions
 from collections import namedtuple
 
 PEMObjects = namedtuple('PEMObjects', ['certificates', 'keys'])
 
-def objectsFromPEM(pemdata):
+_BEGIN = b'-----BEGIN '
+_END = b'-----END '
+_DASHES = b'-----'
+
+
+def pemBlocks(pemdata):
     """
-    Load some objects from a PEM.
+    Find the PEM blocks in C{pemdata} in a single pass, without splitting it
+    into lines.
+
+    Text outside the blocks is ignored, and either line ending is accepted.
+
+    @type pemdata: L{bytes}
+
+    @return: an iterator of C{(label, block)} pairs, where C{label} is the
+        text after C{BEGIN}, such as C{b"CERTIFICATE"}, and C{block} is the
+        complete block, markers included.
+
+    @raise ValueError: if a block is not terminated by a matching C{END}
+        marker.
+    """
+    offset = pemdata.find(_BEGIN)
+    while offset != -1:
+        labelStart = offset + len(_BEGIN)
+        labelEnd = pemdata.find(_DASHES, labelStart)
+        if labelEnd == -1:
+            raise ValueError("Unterminated PEM header at offset %d"
+                             % (offset,))
+        label = pemdata[labelStart:labelEnd]
+        end = pemdata.find(_END + label + _DASHES, labelEnd)
+        if end == -1:
+            raise ValueError("No END marker for PEM %s at offset %d"
+                             % (label.decode('ascii', 'replace'), offset))
+        end += len(_END) + len(label) + len(_DASHES)
+        yield label, pemdata[offset:end]
+        offset = pemdata.find(_BEGIN, end)
+
+
+
+def _splitPEM(pemdata):
+    """
+    Sort the blocks in C{pemdata} into certificates and private keys, in the
+    order they appear; other blocks, such as EC parameters, are skipped.
+
+    @return: a L{PEMObjects} of PEM encoded L{bytes}.
     """
     certificates = []
     keys = []
-    blobs = [b""]
-    for line in pemdata.split(b"\n"):
-        if line.startswith(b'-----BEGIN'):
-            if b'CERTIFICATE' in line:
-                blobs = certificates
-            else:
-                blobs = keys
-            blobs.append(b'')
-        blobs[-1] += line
-        blobs[-1] += b'\n'
-    keys = [KeyPair.load(key, FILETYPE_PEM) for key in keys]
+    for label, block in pemBlocks(pemdata):
+        if label.endswith(b'CERTIFICATE'):
+            certificates.append(block)
+        elif label.endswith(b'PRIVATE KEY'):
+            keys.append(block)
+    return PEMObjects(keys=keys, certificates=certificates)
+
+
+
+def objectsFromPEM(pemdata):
+    """
+    Load some objects from a PEM.
+    """
+    blocks = _splitPEM(pemdata)
+    keys = [KeyPair.load(key, FILETYPE_PEM) for key in blocks.keys]
     certificates = [Certificate.loadPEM(certificate)
-                    for certificate in certificates]
+                    for certificate in blocks.certificates]
     return PEMObjects(keys=keys, certificates=certificates)
 
 
 
-def certificateOptionsFromPileOfPEM(pemdata):
-    objects = objectsFromPEM(pemdata)
-    if len(objects.keys) != 1:
-        raise ValueError("Expected 1 private key, found %d"
-                         % tuple([len(objects.keys)]))
+def certificateOptionsFromPileOfPEM(pemdata, interner=None):
+    """
+    Build the options for a host from a PEM file holding its private key,
+    its certificate and the rest of its certificate chain.
 
-    privateKey = objects.keys[0]
+    The file may hold more than one private key, each of a different type
+    (say, one ECDSA and one RSA), along with the certificate for each; the
+    options then serve whichever certificate each client supports.
 
-    certificatesByFingerprint = dict(
-        [(certificate.getPublicKey().keyHash(), certificate)
-         for certificate in objects.certificates]
+    @param interner: An L{Interner} to share the options, and the keys and
+        certificates in them, with other files that hold the same ones.
+
+    @raise ValueError: if there is no private key, two private keys of the
+        same type, or a private key without its certificate.
+    """
+    blocks = _splitPEM(pemdata)
+    if not blocks.keys:
+        raise ValueError("Expected 1 private key, found 0")
+    if interner is None:
+        interner = Interner()
+    return interner.options(FILETYPE_PEM, blocks.keys, blocks.certificates,
+                            _pairCertificates)
+
+
+
+def _pairCertificates(privateKeys, certificates):
+    """
+    Find the certificate of each of C{privateKeys} among C{certificates},
+    and build the options serving them.
+    """
+    types = [privateKey.type() for privateKey in privateKeys]
+    if len(set(types)) != len(types):
+        raise ValueError("Expected at most 1 private key of each type, "
+                         "found %s" % (", ".join(map(keyType, privateKeys)),))
+
+    # Compare encoded public keys rather than hashing them, checking the
+    # certificates in order since the leaf almost always comes first.
+    publicKeys = [dump_publickey(FILETYPE_ASN1, certificate.get_pubkey())
+                  for certificate in certificates]
+    pairs = []
+    for privateKey in privateKeys:
+        try:
+            index = publicKeys.index(dump_publickey(FILETYPE_ASN1,
+                                                    privateKey))
+        except ValueError:
+            raise ValueError("No certificate matching the %s private key "
+                             "found" % (keyType(privateKey),))
+        pairs.append((certificates[index], privateKey))
+
+    leaves = [certificate for certificate, _ in pairs]
+    chain = [certificate for certificate in certificates
+             if not any(certificate is leaf for leaf in leaves)]
+    return certificateOptionsFor(pairs, chain)
+
+
+
+def certificateOptionsFor(pairs, chain):
+    """
+    Build the options serving some certificates.
+
+    @param pairs: The certificates and their private keys, as
+        C{(certificate, privateKey)} pairs of pyOpenSSL objects, with at
+        most one private key of each type.
+
+    @param chain: The other certificates to send with them.
+
+    @return: a L{CertificateOptions}, or a L{DualCertificateOptions} if
+        there is more than one certificate.
+    """
+    (certificate, privateKey), additional = pairs[0], pairs[1:]
+    if additional:
+        return DualCertificateOptions(
+            privateKey=privateKey,
+            certificate=certificate,
+            extraCertChain=list(chain),
+            additionalCertificates=additional,
+        )
+    return CertificateOptions(
+        privateKey=privateKey,
+        certificate=certificate,
+        extraCertChain=list(chain),
     )
 
-    if privateKey.keyHash() not in certificatesByFingerprint:
-        raise ValueError("No certificate matching %s found")
 
-    openSSLCert = certificatesByFingerprint.pop(privateKey.keyHash()).original
-    openSSLKey = privateKey.original
-    openSSLChain = [c.original for c in certificatesByFingerprint.values()]
 
-    return CertificateOptions(certificate=openSSLCert, privateKey=openSSLKey,
-                              extraCertChain=openSSLChain)
+def _privateKeyDER(privateKey):
+    """
+    DER encode C{privateKey}.
+
+    C{to_cryptography_key} validates RSA keys all over again, which takes
+    tens of milliseconds a key; pyOpenSSL's own, deprecated, serializer
+    does not.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        from OpenSSL.crypto import dump_privatekey
+    return dump_privatekey(FILETYPE_ASN1, privateKey)
+
+
+
+def _encodeOptions(options):
+    """
+    DER encode the private keys and certificates of C{options}.
+
+    @type options: L{CertificateOptions}
+
+    @return: a L{list} of the encoded private keys and a L{list} of the
+        encoded certificates: first the certificate of each key, in the same
+        order, and then the rest of the chain.
+    """
+    pairs = [(options.certificate, options.privateKey)]
+    pairs.extend(getattr(options, 'additionalCertificates', ()))
+    certificates = ([certificate for certificate, _ in pairs]
+                    + list(options.extraCertChain))
+    return ([_privateKeyDER(privateKey) for _, privateKey in pairs],
+            [dump_certificate(FILETYPE_ASN1, certificate)
+             for certificate in certificates])
+
+
+
+def _optionsFromDER(interner, keys, certificates):
+    """
+    Load the options encoded by L{_encodeOptions} through C{interner}.
+    """
+    def build(privateKeys, certificates):
+        return certificateOptionsFor(list(zip(certificates, privateKeys)),
+                                     certificates[len(privateKeys):])
+    return interner.options(FILETYPE_ASN1, keys, certificates, build)
+
+
+
+class Interner(object):
+    """
+    Content-addressed sharing of the keys, certificates and options loaded
+    from encoded data, so that an intermediate certificate that many hosts
+    send, or a certificate many hosts share, is parsed and held once, and
+    hosts with identical files share one context.
+
+    Objects are found by a digest of their encoding, with whitespace
+    ignored in PEM, and only kept while something else refers to them.
+
+    @ivar hits: The number of objects found already loaded.
+    @ivar misses: The number of objects that had to be loaded.
+    """
+    def __init__(self):
+        self._objects = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._objects)
+
+
+    def _intern(self, key, load):
+        obj = self._objects.get(key)
+        if obj is not None:
+            self.hits += 1
+            return obj
+        self.misses += 1
+        obj = load()
+        self._objects[key] = obj
+        return obj
+
+
+    def options(self, fileType, keys, certificates, build):
+        """
+        Get the options for some encoded keys and certificates.
+
+        @param fileType: C{FILETYPE_PEM} or C{FILETYPE_ASN1}.
+        @param keys: The encoded private keys, as L{bytes}.
+        @param certificates: The encoded certificates, as L{bytes}.
+
+        @param build: A callable taking the loaded keys and certificates, as
+            L{list}s of pyOpenSSL objects, and returning the options.  It is
+            only called if no options were built from the same data before.
+
+        @return: the options.
+        """
+        keyDigests = [_digest(fileType, key) for key in keys]
+        certificateDigests = [_digest(fileType, certificate)
+                              for certificate in certificates]
+
+        def load():
+            return build(
+                [self._intern(('key', digest),
+                              partial(load_privatekey, fileType, key))
+                 for digest, key in zip(keyDigests, keys)],
+                [self._intern(('certificate', digest),
+                              partial(load_certificate, fileType,
+                                      certificate))
+                 for digest, certificate in zip(certificateDigests,
+                                                certificates)],
+            )
+        return self._intern(('options', tuple(keyDigests),
+                             tuple(certificateDigests)), load)
+
+
+
+def _digest(fileType, data):
+    if fileType == FILETYPE_PEM:
+        data = b''.join(data.split())
+    return hashlib.sha256(data).digest()
+
+
+
+_KEY_TYPES = {
+    TYPE_RSA: 'RSA',
+    TYPE_DSA: 'DSA',
+    TYPE_EC: 'ECDSA',
+    # pyOpenSSL has no names for these; they are OpenSSL's NIDs.
+    1087: 'Ed25519',
+    1088: 'Ed448',
+}
+
+
+def keyType(key):
+    """
+    Name the type of C{key}, such as C{"RSA"} or C{"ECDSA"}.
+
+    @type key: L{OpenSSL.crypto.PKey}
+
+    @rtype: L{str}
+    """
+    return _KEY_TYPES.get(key.type(), 'unknown')
+
+
+
+class DualCertificateOptions(CertificateOptions):
+    """
+    L{CertificateOptions} serving a certificate for each of several types of
+    key, so that OpenSSL can pick, during each handshake, one the client can
+    verify: typically, a cheap ECDSA certificate for modern clients and an
+    RSA one for the rest.
+
+    pyOpenSSL cannot give each certificate its own chain, so the certificates
+    in C{extraCertChain} are sent whichever certificate is chosen; clients
+    ignore the ones they do not need.
+
+    @ivar additionalCertificates: The C{(certificate, privateKey)} pairs
+        served alongside C{certificate} and C{privateKey}, as pyOpenSSL
+        objects.
+    """
+    def __init__(self, *args, **kwargs):
+        self.additionalCertificates = list(
+            kwargs.pop('additionalCertificates', ())
+        )
+        CertificateOptions.__init__(self, *args, **kwargs)
+
+
+    def _makeContext(self, *args, **kwargs):
+        context = CertificateOptions._makeContext(self, *args, **kwargs)
+        for certificate, privateKey in self.additionalCertificates:
+            context.use_certificate(certificate)
+            context.use_privatekey(privateKey)
+            context.check_privatekey()
+        return context
@@ -3,14 +3,33 @@ from os.path import expanduser
 
 from zope.interface import implementer
 
-from twisted.internet.interfaces import IStreamServerEndpointStringParser
+from twisted.internet.interfaces import (
+    IReactorThreads, IStreamServerEndpointStringParser,
+)
 from twisted.internet.endpoints import serverFromString
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
 from twisted.plugin import IPlugin
+from twisted.web.client import Agent
 
+from txsni.acme import ChallengeStore
 from txsni.snimap import SNIMap
 from txsni.snimap import HostDirectoryMap
+from txsni.metrics import SNIMetrics
+from txsni.ocsp import HTTPOCSPFetcher, OCSPStapler
+from txsni.offload import HandshakePool
+from txsni.sessions import SessionCache
+from txsni.settings import ContextSettings, versionNamed
+from txsni.sqlitemap import SQLiteCertificateMap, isSQLiteDatabase
+from txsni.store import CertificateStore
 from twisted.python.filepath import FilePath
 from txsni.tlsendpoint import TLSEndpoint
+from txsni.workers import (
+    ReusePortTCPEndpoint, WorkerPool, WorkerPoolEndpoint,
+)
+
+_log = Logger()
+
 
 @implementer(IStreamServerEndpointStringParser,
              IPlugin)
@@ -18,13 +37,239 @@ class SNIDirectoryParser(object):
     prefix = 'txsni'
 
     def parseStreamServer(self, reactor, pemdir, *args, **kw):
+        """
+        Parse a C{txsni:<pemdir>:<sub-endpoint>} description.
+
+        C{pemdir} may instead name a certificate store compiled with
+        C{python -m txsni.store}, or a SQLite database imported with
+        C{python -m txsni.sqlitemap}; ACME certificates are then read from
+        the C{acme} directory next to it.
+
+        Options consumed here rather than passed on to the sub-endpoint:
+
+            - C{prewarm=yes} loads every certificate in C{pemdir} in a
+              thread pool before the endpoint starts listening.
+
+            - C{watch=yes} watches C{pemdir} and its C{acme} directory with
+              inotify (Linux only), so cached certificates are served without
+              checking the filesystem and are dropped as soon as they change.
+
+            - C{tickets=yes} enables TLS session tickets, with one set of
+              ticket keys shared by every host.
+
+            - C{ticketKeyLifetime=<seconds>} replaces those keys
+              periodically.
+
+            - C{sessionTimeout=<seconds>} enables a server-side session
+              cache shared by every host, with the given session lifetime.
+
+            - C{ocsp=yes} staples OCSP responses fetched, in the background,
+              from each certificate's responder; certificate files must then
+              include the issuing certificate.
+
+            - C{ocspCache=<directory>} keeps those responses on disk.
+
+            - C{metricsInterval=<seconds>} keeps handshake metrics and logs
+              them periodically.
+
+            - C{workers=<count>} runs C{count} processes in all, each
+              listening on the same port with C{SO_REUSEPORT}, by starting
+              copies of this process with the same command line once the
+              endpoint is listening.  The sub-endpoint must then be C{tcp}
+              with an explicit port.
+
+            - C{handshakeThreads=<count>} runs handshakes in a pool of
+              C{count} threads, so their cryptography can use more than one
+              core and does not hold up connections already established.
+
+            - C{acme=memory} answers ACME tls-alpn-01 challenges from a
+              L{txsni.acme.ChallengeStore}, available as the endpoint's
+              C{contextFactory.acme_mapping}, rather than from the C{acme}
+              directory.
+
+            - C{minimumTLSVersion=<version>}, such as C{TLSv1_2}, refuses
+              older versions of TLS.
+
+            - C{ciphers=<cipher string>} limits the ciphers offered, as an
+              OpenSSL cipher string separated by commas.
+
+            - C{curves=<curves>} sets the ECDH curves offered, separated by
+              commas, such as C{X25519,P-256}.
+
+            - C{dhParameters=<file>} loads DH parameters for DHE ciphers.
+
+            - C{contextBudget=<bytes>} keeps built contexts only for the
+              hosts used most recently, within roughly that much memory;
+              sizes may end in C{K}, C{M} or C{G}.
+
+            - C{encodedBudget=<bytes>} keeps the DER encoded keys and
+              certificates of the hosts used next most recently, within that
+              much memory, so their contexts can be rebuilt without reading
+              their files.  Only for a directory of PEM files.
+
+            - C{idleTimeout=<seconds>} drops contexts unused for that long.
+
+            - C{preload=<count>} loads the C{count} most looked up hosts of
+              a SQLite database up front.
+
+            - C{refreshInterval=<seconds>} is how often to check a SQLite
+              database for changed hosts; 10 by default.
+        """
         def colonJoin(items):
             return ':'.join([item.replace(':', '\\:') for item in items])
+        prewarm = _flag(kw.pop('prewarm', 'no'))
+        workers = int(kw.pop('workers', '1'))
+        handshakeThreads = int(kw.pop('handshakeThreads', '0'))
+        watch = _flag(kw.pop('watch', 'no'))
+        acme = kw.pop('acme', 'directory')
+        if acme not in ('directory', 'memory'):
+            raise ValueError("acme= must be directory or memory")
+        contextBudget = kw.pop('contextBudget', None)
+        if contextBudget is not None:
+            contextBudget = _size(contextBudget)
+        encodedBudget = _size(kw.pop('encodedBudget', '0'))
+        idleTimeout = kw.pop('idleTimeout', None)
+        if idleTimeout is not None:
+            idleTimeout = float(idleTimeout)
+        budgets = dict(contextBudget=contextBudget, idleTimeout=idleTimeout,
+                       clock=reactor)
+        preload = int(kw.pop('preload', '0'))
+        refreshInterval = float(kw.pop('refreshInterval', '10'))
+        tickets = _flag(kw.pop('tickets', 'no'))
+        ticketKeyLifetime = kw.pop('ticketKeyLifetime', None)
+        if ticketKeyLifetime is not None:
+            ticketKeyLifetime = float(ticketKeyLifetime)
+        sessionCache = None
+        if 'sessionTimeout' in kw:
+            sessionCache = SessionCache(timeout=int(kw.pop('sessionTimeout')))
+        settings = None
+        minimumVersion = kw.pop('minimumTLSVersion', None)
+        ciphers = kw.pop('ciphers', None)
+        curves = kw.pop('curves', None)
+        dhParameters = kw.pop('dhParameters', None)
+        if (minimumVersion, ciphers, curves, dhParameters) != (None,) * 4:
+            settings = ContextSettings(
+                minimumVersion=(versionNamed(minimumVersion)
+                                if minimumVersion is not None else None),
+                ciphers=ciphers,
+                curves=curves.replace(',', ':') if curves is not None
+                else None,
+                dhParameters=(FilePath(expanduser(dhParameters))
+                              if dhParameters is not None else None),
+            )
+        metrics = None
+        metricsInterval = kw.pop('metricsInterval', None)
+        if metricsInterval is not None:
+            metrics = SNIMetrics()
+        stapler = None
+        ocspCache = kw.pop('ocspCache', None)
+        if _flag(kw.pop('ocsp', 'no')):
+            stapler = OCSPStapler(
+                HTTPOCSPFetcher(Agent(reactor), reactor), reactor,
+                cacheDirectory=(FilePath(expanduser(ocspCache))
+                                if ocspCache is not None else None),
+            )
         sub = colonJoin(list(args) + ['='.join(item) for item in kw.items()])
-        subEndpoint = serverFromString(reactor, sub)
-        mapping = HostDirectoryMap(FilePath(expanduser(pemdir)))
-        acme_mapping = HostDirectoryMap(FilePath(expanduser(pemdir + '/acme')))
-        contextFactory = SNIMap(mapping, acme_mapping)
-        return TLSEndpoint(endpoint=subEndpoint,
-                           contextFactory=contextFactory)
+        if workers > 1:
+            subEndpoint = _reusePortEndpoint(reactor, args, kw)
+        else:
+            subEndpoint = serverFromString(reactor, sub)
+        pemPath = FilePath(expanduser(pemdir))
+        if pemPath.isfile():
+            if prewarm or watch or encodedBudget:
+                raise ValueError("prewarm=, watch= and encodedBudget= need "
+                                 "a directory of PEM files, not a "
+                                 "certificate store")
+            if isSQLiteDatabase(pemPath):
+                mapping = SQLiteCertificateMap(
+                    pemPath,
+                    reactor=(reactor if IReactorThreads.providedBy(reactor)
+                             else None),
+                    **budgets)
+                mapping.preload(preload)
+                refresh = LoopingCall(mapping.refresh)
+                refresh.clock = reactor
+                refresh.start(refreshInterval, now=False).addErrback(
+                    lambda failure: _log.failure(
+                        "Stopped refreshing {path}", failure,
+                        path=pemPath.path))
+            else:
+                mapping = CertificateStore(pemPath, **budgets)
+            acme_mapping = HostDirectoryMap(pemPath.sibling('acme'))
+        else:
+            mapping = HostDirectoryMap(pemPath, encodedBudget=encodedBudget,
+                                       **budgets)
+            acme_mapping = HostDirectoryMap(
+                FilePath(expanduser(pemdir + '/acme'))
+            )
+        if acme == 'memory':
+            acme_mapping = ChallengeStore(clock=reactor)
+        if watch:
+            from txsni.watcher import HostDirectoryWatcher
+            watcher = HostDirectoryWatcher(reactor)
+            watcher.watch(mapping)
+            if acme != 'memory':
+                watcher.watch(acme_mapping)
+        contextFactory = SNIMap(mapping, acme_mapping,
+                                enableSessionTickets=tickets,
+                                ticketKeyLifetime=ticketKeyLifetime,
+                                reactor=reactor,
+                                sessionCache=sessionCache,
+                                stapler=stapler,
+                                metrics=metrics,
+                                settings=settings)
+        if metrics is not None:
+            logMetrics = LoopingCall(metrics.log, contextFactory)
+            logMetrics.clock = reactor
+            logMetrics.start(float(metricsInterval), now=False)
+        ready = mapping.prewarm(reactor) if prewarm else None
+        endpoint = TLSEndpoint(endpoint=subEndpoint,
+                               contextFactory=contextFactory,
+                               ready=ready,
+                               handshakePool=(HandshakePool(reactor,
+                                                            handshakeThreads)
+                                              if handshakeThreads else None))
+        if workers > 1:
+            endpoint = WorkerPoolEndpoint(endpoint,
+                                          WorkerPool(reactor, workers))
+        return endpoint
+
+
+
+def _reusePortEndpoint(reactor, args, kw):
+    """
+    Build a L{ReusePortTCPEndpoint} from the arguments of a C{tcp}
+    sub-endpoint description.
+    """
+    args = list(args)
+    if not args or args.pop(0) != 'tcp':
+        raise ValueError("workers= requires a tcp sub-endpoint")
+    port = int(args[0] if args else kw['port'])
+    if port == 0:
+        raise ValueError("workers= requires an explicit port")
+    return ReusePortTCPEndpoint(reactor, port,
+                                interface=kw.get('interface', ''),
+                                backlog=int(kw.get('backlog', 50)))
+
+
+
+_SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def _size(value):
+    """
+    Interpret a size in bytes, optionally ending in C{K}, C{M} or C{G}, from
+    an endpoint description.
+    """
+    multiplier = _SIZE_SUFFIXES.get(value[-1:].upper())
+    if multiplier is not None:
+        return int(value[:-1]) * multiplier
+    return int(value)
+
+
+
+def _flag(value):
+    """
+    Interpret a yes/no option from an endpoint description.
+    """
+    return value.lower() in ('yes', 'true', 'on', '1')
 
@@ -0,0 +1,185 @@
+"""
+Look up certificates by the names they are actually valid for.
+"""
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+
+from twisted.logger import Logger
+
+from txsni.only_noticed_pypi_pem_after_i_wrote_this import (
+    Interner, certificateOptionsFromPileOfPEM
+)
+
+_log = Logger()
+
+
+def normalizeHostname(hostname):
+    """
+    Normalize a hostname for use as an index key: lower-cased, with
+    internationalized labels converted to their IDNA (A-label) form.  A
+    leading C{*} wildcard label is preserved.
+
+    @param hostname: The hostname, as sent in an SNI extension or found in a
+        certificate.
+    @type hostname: L{bytes} or L{unicode}
+
+    @return: the normalized hostname.
+    @rtype: L{unicode}
+
+    @raise UnicodeError: if the hostname cannot be IDNA encoded.
+    """
+    if isinstance(hostname, bytes):
+        hostname = hostname.decode('ascii')
+    labels = hostname.rstrip(u'.').split(u'.')
+    return u'.'.join(
+        label if label == u'*' else label.encode('idna').decode('ascii')
+        for label in labels
+    ).lower()
+
+
+
+def dnsNamesForCertificate(certificate):
+    """
+    Find the DNS names a certificate is valid for.
+
+    @param certificate: The certificate.
+    @type certificate: L{OpenSSL.crypto.X509}
+
+    @return: the DNS names from the subject alternative name extension or,
+        if there is none, the subject's common names.
+    @rtype: L{list} of L{unicode}
+    """
+    certificate = certificate.to_cryptography()
+    try:
+        extension = certificate.extensions.get_extension_for_class(
+            x509.SubjectAlternativeName
+        )
+    except x509.ExtensionNotFound:
+        return [attribute.value for attribute in
+                certificate.subject.get_attributes_for_oid(
+                    NameOID.COMMON_NAME
+                )]
+    return extension.value.get_values_for_type(x509.DNSName)
+
+
+
+class HostnameIndex(object):
+    """
+    An index of values by hostname, supporting exact names and single-label
+    C{*.} wildcards.  Lookups cost at most two dictionary probes.
+    """
+    def __init__(self):
+        self._exact = {}
+        self._wildcard = {}
+
+
+    def add(self, name, value):
+        """
+        Index C{value} under C{name}, unless something is already indexed
+        under that name.
+
+        @param name: An exact hostname, or a wildcard such as
+            C{*.example.com}.
+        @type name: L{bytes} or L{unicode}
+        """
+        name = normalizeHostname(name)
+        if name.startswith(u'*.'):
+            self._wildcard.setdefault(name[2:], value)
+        else:
+            self._exact.setdefault(name, value)
+
+
+    def __getitem__(self, hostname):
+        value = self.get(hostname)
+        if value is None:
+            raise KeyError(hostname)
+        return value
+
+
+    def get(self, hostname, default=None):
+        try:
+            hostname = normalizeHostname(hostname)
+        except UnicodeError:
+            return default
+        value = self._exact.get(hostname)
+        if value is None:
+            value = self._wildcard.get(hostname.partition(u'.')[2], default)
+        return value
+
+
+    def __len__(self):
+        return len(self._exact) + len(self._wildcard)
+
+
+
+class SANDirectoryMap(object):
+    """
+    A mapping of hostnames to L{CertificateOptions}, loaded from every
+    C{.pem} file in a directory and indexed by the names each certificate
+    covers, so a single file serves all of its subject alternative names
+    (including wildcards) with one shared context.
+
+    A file is also indexed under its own name, less the C{.pem} extension,
+    so C{DEFAULT.pem} continues to provide the C{DEFAULT} entry.  When more
+    than one file covers a name, files are considered in sorted order and
+    the first one wins; exact names always win over wildcards.
+
+    Files are loaded through an L{Interner}, so reloading only parses the
+    ones whose contents changed.
+    """
+    def __init__(self, directoryPath, interner=None):
+        self.directoryPath = directoryPath
+        self.interner = Interner() if interner is None else interner
+        self.reload()
+
+
+    def reload(self):
+        """
+        Re-read every certificate file in the directory and rebuild the
+        index.
+        """
+        index = HostnameIndex()
+        pemFiles = sorted(self.directoryPath.globChildren('*.pem'),
+                          key=lambda filePath: filePath.path)
+        loaded = []
+        for filePath in pemFiles:
+            try:
+                options = certificateOptionsFromPileOfPEM(
+                    filePath.getContent(), self.interner
+                )
+            except Exception:
+                _log.failure("Could not load {path}", path=filePath.path)
+                continue
+            self._add(index, filePath.basename()[:-len('.pem')], options,
+                      filePath)
+            loaded.append((filePath, options))
+        for filePath, options in loaded:
+            for name in dnsNamesForCertificate(options.certificate):
+                self._add(index, name, options, filePath)
+        self._index = index
+
+
+    def _add(self, index, name, options, filePath):
+        """
+        Index C{options}, loaded from C{filePath}, under C{name}, skipping
+        names that cannot be IDNA encoded, such as those with overlong
+        labels, rather than the whole reload.
+        """
+        try:
+            index.add(name, options)
+        except UnicodeError as e:
+            _log.warn("Skipping {name!r} from {path}: {error}", name=name,
+                      path=filePath.path, error=e)
+
+
+    def __getitem__(self, hostname):
+        if hostname is None:
+            hostname = "DEFAULT"
+        return self._index[hostname]
+
+
+    def get(self, hostname, default=None):
+        if hostname is None:
+            hostname = "DEFAULT"
+        return self._index.get(hostname, default)
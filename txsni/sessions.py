@@ -0,0 +1,57 @@
+"""
+Server-side TLS session caching shared by every context an L{SNIMap}
+manages.
+"""
+
+from OpenSSL import SSL
+
+
+class SessionCache(object):
+    """
+    A session ID caching policy applied to every context an L{SNIMap} hands
+    out.
+
+    OpenSSL stores and looks up sessions in the cache of the context each
+    connection starts on, but only resumes a session if the context that
+    ends up serving the connection has the same session ID context and has
+    caching enabled.  Each L{CertificateOptions} context gets a random
+    session ID context of its own, and caching turned off, so without this
+    policy sessions cannot be resumed once L{SNIMap.selectContext} has
+    swapped contexts.
+
+    OpenSSL's own in-process cache is used; it holds at most OpenSSL's
+    default number of sessions (20480), expiring them after C{timeout}
+    seconds.
+
+    @ivar hits: The number of handshakes that resumed a session.
+    @ivar misses: The number of full handshakes.
+    """
+    def __init__(self, timeout=300, sessionIDContext=b"txsni"):
+        self.timeout = timeout
+        self.sessionIDContext = sessionIDContext
+        self.hits = 0
+        self.misses = 0
+
+
+    def configure(self, context):
+        """
+        Apply this policy to C{context}, which must not have been used for a
+        connection yet.
+
+        @type context: L{OpenSSL.SSL.Context}
+        """
+        context.set_session_id(self.sessionIDContext)
+        context.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+        context.set_timeout(self.timeout)
+
+
+    def handshakeDone(self, resumed):
+        """
+        Count a completed handshake.
+
+        @param resumed: Whether it resumed a session.
+        """
+        if resumed:
+            self.hits += 1
+        else:
+            self.misses += 1
@@ -0,0 +1,125 @@
+"""
+TLS settings shared by every context an L{SNIMap} hands out.
+"""
+
+from OpenSSL import SSL
+# pyOpenSSL can neither set a list of curves nor load DH parameters from
+# memory.
+from OpenSSL._util import ffi as _ffi, lib as _lib
+
+from twisted.internet.ssl import (
+    AcceptableCiphers, CertificateOptions, TLSVersion,
+)
+
+_PROTOCOL_VERSIONS = {
+    TLSVersion.TLSv1_0: SSL.TLS1_VERSION,
+    TLSVersion.TLSv1_1: SSL.TLS1_1_VERSION,
+    TLSVersion.TLSv1_2: SSL.TLS1_2_VERSION,
+    TLSVersion.TLSv1_3: SSL.TLS1_3_VERSION,
+}
+
+
+class ContextSettings(object):
+    """
+    A protocol floor, cipher string, list of ECDH curves and DH parameters
+    applied by L{SNIMap} to every context before its first use, so that every
+    host is served with the same settings.
+
+    Each setting is checked and resolved once, when the settings are made -
+    the cipher string into the ciphers this OpenSSL supports, the DH
+    parameters into an OpenSSL object - so that applying them to a context
+    is only a handful of calls into OpenSSL.
+
+    Session caching and tickets are configured on L{SNIMap} itself.
+    """
+    def __init__(self, minimumVersion=None, ciphers=None, curves=None,
+                 dhParameters=None):
+        """
+        @param minimumVersion: The lowest TLS version to accept.
+        @type minimumVersion: L{TLSVersion}
+
+        @param ciphers: An OpenSSL cipher string, limiting the TLS 1.2 and
+            earlier ciphers offered.
+        @type ciphers: L{str}
+
+        @param curves: The ECDH curves, or groups, to offer, in order of
+            preference, separated by colons, such as C{"X25519:P-256"}.
+        @type curves: L{str}
+
+        @param dhParameters: A file of PEM encoded DH parameters.
+        @type dhParameters: L{FilePath}
+
+        @raise ValueError: if a setting is not supported by this OpenSSL.
+        """
+        self.minimumVersion = minimumVersion
+        self._minimumVersion = None
+        if minimumVersion is not None:
+            self._minimumVersion = _PROTOCOL_VERSIONS[minimumVersion]
+        self._cipherList = None
+        if ciphers is not None:
+            options = CertificateOptions(
+                acceptableCiphers=AcceptableCiphers.fromOpenSSLCipherString(
+                    ciphers
+                )
+            )
+            self._cipherList = options._cipherString.encode("ascii")
+        self._curves = None
+        if curves is not None:
+            self._curves = curves.encode("ascii")
+        self._dh = None
+        if dhParameters is not None:
+            self._dh = _loadDHParameters(dhParameters.getContent())
+        # Find out now if OpenSSL will take the curves and DH parameters.
+        self._configureOpenSSL(SSL.Context(SSL.TLS_METHOD))
+
+
+    def configure(self, context):
+        """
+        Apply these settings to C{context}, which must not have been used
+        for a connection yet.
+        """
+        if self._minimumVersion is not None:
+            context.set_min_proto_version(self._minimumVersion)
+        if self._cipherList is not None:
+            context.set_cipher_list(self._cipherList)
+        self._configureOpenSSL(context)
+
+
+    def _configureOpenSSL(self, context):
+        if self._curves is not None and not _lib.SSL_CTX_set1_curves_list(
+                context._context, self._curves):
+            raise ValueError("Unsupported curves: %s"
+                             % (self._curves.decode("ascii"),))
+        if self._dh is not None and not _lib.SSL_CTX_set_tmp_dh(
+                context._context, self._dh):
+            raise ValueError("DH parameters rejected; they may be too small")
+
+
+
+def _loadDHParameters(pemdata):
+    """
+    Load PEM encoded DH parameters.
+
+    @raise ValueError: if C{pemdata} does not hold DH parameters.
+    """
+    bio = _ffi.gc(_lib.BIO_new_mem_buf(pemdata, len(pemdata)), _lib.BIO_free)
+    dh = _lib.PEM_read_bio_DHparams(bio, _ffi.NULL, _ffi.NULL, _ffi.NULL)
+    if dh == _ffi.NULL:
+        raise ValueError("No DH parameters found")
+    return _ffi.gc(dh, _lib.DH_free)
+
+
+
+def versionNamed(name):
+    """
+    Look up a L{TLSVersion} by its name, such as C{"TLSv1_2"}.
+
+    @raise ValueError: if there is no such version.
+    """
+    try:
+        version = TLSVersion.lookupByName(name)
+    except ValueError:
+        raise ValueError("Unknown TLS version %r" % (name,))
+    if version not in _PROTOCOL_VERSIONS:
+        raise ValueError("Unsupported TLS version %r" % (name,))
+    return version
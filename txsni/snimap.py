@@ -1,18 +1,47 @@
 import collections
+import os
+import re
+import stat
+import time
+import weakref
 
 from functools import wraps
 
 from zope.interface import implementer
 
-from OpenSSL.SSL import Connection
+from OpenSSL.SSL import Connection, SSL_CB_HANDSHAKE_DONE
+# pyOpenSSL has no public way to ask whether a connection was resumed.
+from OpenSSL._util import lib as _lib
 
-from twisted.internet.interfaces import IOpenSSLServerConnectionCreator
+from twisted.internet.defer import gatherResults
+from twisted.internet.interfaces import (
+    IOpenSSLServerConnectionCreator, IProtocolNegotiationFactory,
+)
 from twisted.internet.ssl import CertificateOptions
-
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.logger import Logger
+from twisted.python.filepath import InsecurePath
+
+from txsni.acme import ACME_TLS_1
+from txsni.cache import TieredCache
+from txsni.offload import inReactor
 from txsni.only_noticed_pypi_pem_after_i_wrote_this import (
-    certificateOptionsFromPileOfPEM
+    DualCertificateOptions, Interner, certificateOptionsFromPileOfPEM,
+    keyType,
 )
 
+_log = Logger()
+
+# What pyOpenSSL's ValueError says when a context already used for a
+# connection is changed.
+_CONTEXT_IN_USE = "already been used"
+
+try:
+    _now = time.perf_counter
+except AttributeError:
+    _now = time.time
+
 
 class _NegotiationData(object):
     """
@@ -46,34 +75,31 @@ class _NegotiationData(object):
         context.set_alpn_protos(self.alpnProtocols)
 
 
-class _ConnectionProxy(object):
+class _SNIConnection(Connection):
     """
-    A basic proxy for an OpenSSL Connection object that returns a ContextProxy
-    wrapping the actual OpenSSL Context whenever it's asked for.
+    An OpenSSL Connection whose C{get_context} returns a L{_ContextProxy}, so
+    that NPN and ALPN callbacks set through it are recorded by the factory
+    and carried over when L{SNIMap.selectContext} swaps contexts.
+
+    Every other method is the Connection's own, so the reads and writes
+    Twisted makes for the life of the connection go straight to pyOpenSSL.
     """
-    def __init__(self, original, factory):
-        self._obj = original
+    def __init__(self, context, factory):
+        Connection.__init__(self, context, None)
         self._factory = factory
+        self._contextProxy = None
 
     def get_context(self):
         """
-        A basic override of get_context to ensure that the appropriate proxy
-        object is returned.
+        Get the proxy for the current context, which is only replaced when
+        the context is.
         """
-        ctx = self._obj.get_context()
-        return _ContextProxy(ctx, self._factory)
-
-    def __getattr__(self, attr):
-        return getattr(self._obj, attr)
-
-    def __setattr__(self, attr, val):
-        if attr in ('_obj', '_factory'):
-            self.__dict__[attr] = val
-        else:
-            setattr(self._obj, attr, val)
-
-    def __delattr__(self, attr):
-        return delattr(self._obj, attr)
+        context = Connection.get_context(self)
+        proxy = self._contextProxy
+        if proxy is None or proxy._obj is not context:
+            proxy = self._contextProxy = _ContextProxy(context,
+                                                       self._factory)
+        return proxy
 
 
 class _ContextProxy(object):
@@ -95,10 +121,14 @@ class _ContextProxy(object):
         return self._obj.set_npn_select_callback(cb)
 
     def set_alpn_select_callback(self, cb):
+        # The callback is stored alongside the context, so it must not refer
+        # back to this proxy (and hence to the context) or the context could
+        # never be collected.
+        factory = self._factory
 
         @wraps(cb)
         def alpn_callback(connection, protocols):
-            return self._factory.selectAlpn(lambda: cb(connection, protocols), connection, protocols)
+            return factory.selectAlpn(lambda: cb(connection, protocols), connection, protocols)
 
         self._factory._alpnSelectCallbackForContext(self._obj, alpn_callback)
         return self._obj.set_alpn_select_callback(alpn_callback)
@@ -122,19 +152,173 @@ class _ContextProxy(object):
 
 @implementer(IOpenSSLServerConnectionCreator)
 class SNIMap(object):
-    def __init__(self, mapping, acme_mapping=None):
+    """
+    Selects a certificate for each connection based on the server name the
+    client asks for.
+
+    Server names that are not syntactically valid hostnames, or that the
+    mapping has no certificate for, are served the default certificate.
+
+    Every connection starts out on C{self.context}, and OpenSSL issues and
+    decrypts session tickets with that context's keys whichever host's
+    context is swapped in later.  So with C{enableSessionTickets}, a single
+    set of ticket keys is shared by every host; with C{ticketKeyLifetime},
+    that context, and so its keys, is replaced every C{ticketKeyLifetime}
+    seconds.  Tickets issued under the previous keys are not accepted after
+    a rotation; those clients perform a full handshake instead.
+
+    If a C{sessionCache} (a L{txsni.sessions.SessionCache}) is given, it is
+    applied to every context before its first use, so that sessions can be
+    resumed by ID whichever host's context serves them.  Likewise, a
+    C{stapler} (a L{txsni.ocsp.OCSPStapler}) staples an OCSP response for
+    each context's certificate, and C{settings} (a
+    L{txsni.settings.ContextSettings}) sets the protocol floor, ciphers,
+    curves and DH parameters of every context.  If C{metrics} (a
+    L{txsni.metrics.SNIMetrics}) is given, it is kept up to date as
+    handshakes happen.
+
+    Clients offering the C{acme-tls/1} protocol over ALPN are served the
+    challenge certificate C{acme_mapping} has for their server name, if
+    any, such as from a L{txsni.acme.ChallengeStore}.  Challenge contexts
+    are used as they are, with none of the settings above.
+
+    The callbacks OpenSSL makes during a handshake always run in the reactor
+    thread, even when the handshake itself runs in a
+    L{txsni.offload.HandshakePool}.
+
+    @ivar rejectedNames: The number of invalid server names seen.
+    @ivar unknownNames: The number of valid server names that the mapping had
+        no certificate for.
+    """
+    def __init__(self, mapping, acme_mapping=None,
+                 enableSessionTickets=False, ticketKeyLifetime=None,
+                 reactor=None, sessionCache=None, stapler=None,
+                 metrics=None, settings=None):
         self.mapping = mapping
         self.acme_mapping = acme_mapping
-        self._negotiationDataForContext = collections.defaultdict(
-            _NegotiationData
-        )
+        self.enableSessionTickets = enableSessionTickets
+        self.sessionCache = sessionCache
+        self.stapler = stapler
+        self.metrics = metrics
+        self.settings = settings
+        self._preparedContexts = weakref.WeakSet()
+        self.rejectedNames = 0
+        self.unknownNames = 0
+        # Keyed weakly so that the negotiation data for a context goes away
+        # along with the context itself, rather than growing forever.
+        self._negotiationDataForContext = weakref.WeakKeyDictionary()
+        self.context = self._makeInitialContext()
+        self._ticketKeyRotation = None
+        if enableSessionTickets and ticketKeyLifetime is not None:
+            self._ticketKeyRotation = LoopingCall(self.rotateSessionTicketKeys)
+            if reactor is not None:
+                self._ticketKeyRotation.clock = reactor
+            self._ticketKeyRotation.start(ticketKeyLifetime, now=False)
+
+    def _makeInitialContext(self):
+        """
+        Build the context that every connection starts out on, from the
+        mapping's C{DEFAULT} entry if it has one.
+        """
+        options = _lookup(self.mapping, 'DEFAULT')
+        if options is None:
+            options = CertificateOptions()
+        if self.enableSessionTickets:
+            options = DualCertificateOptions(
+                certificate=options.certificate,
+                privateKey=options.privateKey,
+                extraCertChain=options.extraCertChain,
+                additionalCertificates=getattr(
+                    options, 'additionalCertificates', ()
+                ),
+                enableSessionTickets=True,
+            )
+        context = options.getContext()
+        if not self._prepareContext(context, options):
+            raise ValueError("The DEFAULT context is already in use")
+        context.set_tlsext_servername_callback(inReactor(self.selectContext))
+        return context
+
+    def _prepareContext(self, context, options):
+        """
+        Apply the settings shared by every context this map hands out to
+        C{context}, built from C{options}, unless that has already been done.
+
+        @return: whether C{context} has them; if not, because it was used
+            for a connection elsewhere before they could be applied, it must
+            not be served.
+
+        @raise ValueError: if a setting cannot be applied for any other
+            reason.
+        """
+        if context in self._preparedContexts:
+            return True
         try:
-            self.context = self.mapping['DEFAULT'].getContext()
-        except KeyError:
-            self.context = CertificateOptions().getContext()
-        self.context.set_tlsext_servername_callback(
-            self.selectContext
-        )
+            if self.settings is not None:
+                self.settings.configure(context)
+            if self.sessionCache is not None:
+                self.sessionCache.configure(context)
+            if self.sessionCache is not None or self.metrics is not None:
+                context.set_info_callback(self._infoCallback)
+            if self.stapler is not None:
+                self.stapler.configure(context, options)
+            if self.acme_mapping is not None:
+                context.set_alpn_select_callback(
+                    self._alpnSelectCallback(options)
+                )
+        except ValueError as e:
+            # pyOpenSSL refuses to change a context that has already been
+            # used for a connection elsewhere.
+            if _CONTEXT_IN_USE not in str(e):
+                raise
+            _log.warn("Could not configure a context already in use")
+            return False
+        self._preparedContexts.add(context)
+        return True
+
+    def _alpnSelectCallback(self, options):
+        """
+        Wrap the ALPN select callback for contexts built from C{options} in
+        L{selectAlpn}, so that ACME challenges are answered whichever context
+        the connection is on.
+        """
+        select = _alpnSelect(
+            getattr(options, '_acceptableProtocols', None) or ())
+
+        @inReactor
+        def alpnSelectCallback(connection, protocols):
+            return self.selectAlpn(lambda: select(connection, protocols),
+                                   connection, protocols)
+        return alpnSelectCallback
+
+    def _infoCallback(self, connection, where, ret):
+        if where & SSL_CB_HANDSHAKE_DONE:
+            self._handshakeDone(connection)
+
+    @inReactor
+    def _handshakeDone(self, connection):
+        resumed = bool(_lib.SSL_session_reused(connection._ssl))
+        if self.sessionCache is not None:
+            self.sessionCache.handshakeDone(resumed)
+        if self.metrics is not None:
+            if resumed:
+                self.metrics.resumed += 1
+            else:
+                self.metrics.full += 1
+            certificate = connection.get_certificate()
+            if certificate is not None:
+                self.metrics.handshakesByKeyType[
+                    keyType(certificate.get_pubkey())
+                ] += 1
+
+    def rotateSessionTicketKeys(self):
+        """
+        Start issuing session tickets under new keys, by replacing the context
+        new connections start out on.  This does nothing unless session
+        tickets are enabled.
+        """
+        if self.enableSessionTickets:
+            self.context = self._makeInitialContext()
 
     def selectAlpn(self, default, connection, protocols):
         """
@@ -146,26 +330,69 @@ class SNIMap(object):
 
         The acme protocol doesn't need to send or receive other data.
         """
-        ACME_TLS_1 = b'acme-tls/1'
-        if not ACME_TLS_1 in protocols or not self.acme_mapping:
+        if ACME_TLS_1 not in protocols or not self.acme_mapping:
+            return default()
+        if not self.selectContext(connection, mapping=self.acme_mapping):
             return default()
-        self.selectContext(connection, mapping=self.acme_mapping)
-        # does this mess up 'normal' connections to the same context?
-        # is this really a context from a separate directory?
-        connection.get_context().set_alpn_protos([ACME_TLS_1])
+        if self.metrics is not None:
+            self.metrics.acmeChallenges += 1
+        # OpenSSL keeps the protocol chosen here; the challenge context
+        # itself is left untouched, so it can serve the next challenge too.
         return ACME_TLS_1
 
     def selectContext(self, connection, mapping=None):
-        mapping = mapping or self.mapping
-
-        oldContext = connection.get_context()
-        newContext = mapping[connection.get_servername()].getContext()
+        """
+        Switch C{connection} to the context for the server name it asked
+        for, if C{mapping} (by default, C{self.mapping}) has one.
 
-        negotiationData = self._negotiationDataForContext[oldContext]
-        negotiationData.negotiateNPN(newContext)
-        negotiationData.negotiateALPN(newContext)
+        @return: whether the context was switched.
+        """
+        mapping = mapping or self.mapping
+        metrics = self.metrics
+        # The ACME challenge lookup is a second look at the same handshake,
+        # and its contexts are kept apart from those of normal traffic.
+        challenge = mapping is not self.mapping
+        counted = metrics is not None and not challenge
+
+        servername = connection.get_servername()
+        if servername is not None and not _isValidServerName(servername):
+            self.rejectedNames += 1
+            if counted:
+                metrics.defaultFallbacks += 1
+            return False
+        if counted:
+            started = _now()
+        options = _lookup(mapping, servername)
+        if counted:
+            lookedUp = _now()
+            metrics.lookupSeconds += lookedUp - started
+        if options is None:
+            self.unknownNames += 1
+            if counted:
+                metrics.defaultFallbacks += 1
+            return False
+
+        newContext = options.getContext()
+        if challenge:
+            connection.set_context(newContext)
+            return True
+        # The context itself, rather than any proxy for it.
+        oldContext = Connection.get_context(connection)
+        if not self._prepareContext(newContext, options):
+            if counted:
+                metrics.defaultFallbacks += 1
+            return False
+        if counted:
+            metrics.contextSeconds += _now() - lookedUp
+            metrics.countHandshake(servername)
+
+        negotiationData = self._negotiationDataForContext.get(oldContext)
+        if negotiationData is not None:
+            negotiationData.negotiateNPN(newContext)
+            negotiationData.negotiateALPN(newContext)
 
         connection.set_context(newContext)
+        return True
 
     def serverConnectionForTLS(self, protocol):
         """
@@ -177,34 +404,278 @@ class SNIMap(object):
         @return: a connection
         @rtype: L{OpenSSL.SSL.Connection}
         """
-        conn = Connection(self.context, None)
-        return _ConnectionProxy(conn, self)
+        return _SNIConnection(self.context, self)
+
+    def _negotiationDataFor(self, context):
+        negotiationData = self._negotiationDataForContext.get(context)
+        if negotiationData is None:
+            negotiationData = _NegotiationData()
+            self._negotiationDataForContext[context] = negotiationData
+        return negotiationData
 
     def _npnAdvertiseCallbackForContext(self, context, callback):
-        self._negotiationDataForContext[context].npnAdvertiseCallback = (
-            callback
-        )
+        self._negotiationDataFor(context).npnAdvertiseCallback = callback
 
     def _npnSelectCallbackForContext(self, context, callback):
-        self._negotiationDataForContext[context].npnSelectCallback = callback
+        self._negotiationDataFor(context).npnSelectCallback = callback
 
     def _alpnSelectCallbackForContext(self, context, callback):
-        self._negotiationDataForContext[context].alpnSelectCallback = callback
+        self._negotiationDataFor(context).alpnSelectCallback = callback
 
     def _alpnProtocolsForContext(self, context, protocols):
-        self._negotiationDataForContext[context].alpnProtocols = protocols
+        self._negotiationDataFor(context).alpnProtocols = protocols
+
+
+_VALID_SERVER_NAME = re.compile(
+    br"^(?=.{1,253}\.?\Z)[A-Za-z0-9_](?:[A-Za-z0-9_-]{0,61}[A-Za-z0-9_])?"
+    br"(?:\.[A-Za-z0-9_](?:[A-Za-z0-9_-]{0,61}[A-Za-z0-9_])?)*\.?\Z"
+)
+
+
+def _isValidServerName(servername):
+    """
+    Is C{servername}, as sent by a client, a syntactically valid hostname?
+    """
+    return _VALID_SERVER_NAME.match(servername) is not None
+
+
+
+def _alpnSelect(acceptableProtocols):
+    """
+    Make an ALPN select callback choosing the first protocol the client
+    offers too, as Twisted's own contexts do: those of the connection's
+    factory, if it is an L{IProtocolNegotiationFactory}, in order of
+    preference, and then C{acceptableProtocols}.  With no protocol in
+    common, it returns C{b""} and no protocol is negotiated.
+    """
+    def select(connection, protocols):
+        preferred = list(acceptableProtocols)
+        tlsProtocol = connection.get_app_data()
+        factory = getattr(getattr(tlsProtocol, "factory", None),
+                          "wrappedFactory", None)
+        negotiating = IProtocolNegotiationFactory(factory, None)
+        if negotiating is not None:
+            preferred = list(negotiating.acceptableProtocols()) + preferred
+        for protocol in preferred:
+            if protocol in protocols:
+                return protocol
+        return b""
+    return select
+
+
+
+def _lookup(mapping, hostname):
+    """
+    Look up C{hostname} in C{mapping}, preferring its C{get} method so that
+    no exception needs to be raised for unknown names.
+
+    @return: the options for C{hostname}, or L{None}.
+    """
+    get = getattr(mapping, "get", None)
+    if get is not None:
+        return get(hostname)
+    try:
+        return mapping[hostname]
+    except KeyError:
+        return None
+
 
 
 class HostDirectoryMap(object):
-    def __init__(self, directoryPath):
+    """
+    A mapping of hostnames to L{CertificateOptions}, loaded from
+    C{<hostname>.pem} files in a directory.
+
+    Parsed options (and therefore the OpenSSL context they build) are cached
+    per hostname, and reused for as long as the identity of the file on disk
+    - its inode, modification time and size - does not change.  Replacing or
+    rewriting a certificate file is therefore picked up on the next lookup.
+    Files with the same keys and certificates share one set of options, and
+    so one context, through the mapping's L{Interner}.
+
+    By default every host's options are kept once loaded.  With
+    C{contextBudget} or C{encodedBudget}, they are kept in a L{TieredCache}
+    instead, where only the hosts used most recently keep their context and
+    the next ones keep their DER encoded keys and certificates, within the
+    given byte budgets.
+
+    Hostnames with no file are remembered for C{unknownTTL} seconds, up to
+    C{unknownCacheSize} of them, so repeated requests for them do not touch
+    the filesystem; a certificate added for such a name may therefore take
+    that long to be noticed, unless the mapping is watched.
+
+    @ivar hits: The number of lookups answered from the cache.
+    @ivar misses: The number of lookups that had to parse a PEM file.
+    @ivar unknown: The number of lookups for hostnames with no file.
+    @ivar interner: The L{Interner} the mapping loads certificates through.
+    @ivar watched: Whether something else (such as a
+        L{txsni.watcher.HostDirectoryWatcher}) is responsible for calling
+        L{invalidate} when files change, so cached entries can be returned
+        without checking the file.
+    """
+    def __init__(self, directoryPath, unknownTTL=10.0,
+                 unknownCacheSize=10000, clock=None, interner=None,
+                 contextBudget=None, encodedBudget=0, idleTimeout=None):
         self.directoryPath = directoryPath
+        self.interner = Interner() if interner is None else interner
+        self.unknownTTL = unknownTTL
+        self.unknownCacheSize = unknownCacheSize
+        self._now = time.time if clock is None else clock.seconds
+        self._cache = TieredCache(contextBudget, encodedBudget, idleTimeout,
+                                  clock, self.interner)
+        self._unknown = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.unknown = 0
+        self.watched = False
 
 
     def __getitem__(self, hostname):
+        options = self.get(hostname)
+        if options is None:
+            raise KeyError("no pem file for %r" % (hostname,))
+        return options
+
+
+    def get(self, hostname, default=None):
+        """
+        Look up the options for C{hostname}.
+
+        @return: the options, or C{default} if there is no file for
+            C{hostname}.
+        """
+        if hostname is None:
+            hostname = u"DEFAULT"
+        elif isinstance(hostname, bytes):
+            try:
+                hostname = hostname.decode("ascii")
+            except UnicodeDecodeError:
+                self.unknown += 1
+                return default
+        cached = self._cache.get(hostname)
+        if cached is not None and self.watched:
+            self.hits += 1
+            return cached[1]
+        expires = self._unknown.get(hostname)
+        if expires is not None:
+            if expires > self._now():
+                self.unknown += 1
+                return default
+            del self._unknown[hostname]
+        try:
+            filePath = self.directoryPath.child(hostname)
+        except InsecurePath:
+            self.unknown += 1
+            return default
+        filePath = filePath.siblingExtension(".pem")
+        identity = _fileIdentity(filePath)
+        if identity is None:
+            self._cache.pop(hostname)
+            self._rememberUnknown(hostname)
+            self.unknown += 1
+            return default
+        if cached is not None and cached[0] == identity:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        options = certificateOptionsFromPileOfPEM(filePath.getContent(),
+                                                  self.interner)
+        self._cache.put(hostname, identity, options)
+        return options
+
+
+    def _rememberUnknown(self, hostname):
+        self._unknown[hostname] = self._now() + self.unknownTTL
+        while len(self._unknown) > self.unknownCacheSize:
+            self._unknown.popitem(last=False)
+
+
+    @property
+    def cacheSize(self):
+        """
+        The number of hosts whose options are cached.
+        """
+        return len(self._cache)
+
+
+    def memoryUsage(self):
+        """
+        The estimated bytes used by cached options.
+
+        @see: L{TieredCache.memoryUsage}
+        """
+        return self._cache.memoryUsage()
+
+
+    def invalidate(self, hostname=None):
+        """
+        Forget what is cached about C{hostname}, or about every host if it is
+        L{None}.
+        """
         if hostname is None:
-            hostname = "DEFAULT"
-        filePath = self.directoryPath.child(hostname).siblingExtension(".pem")
-        if filePath.isfile():
-            return certificateOptionsFromPileOfPEM(filePath.getContent())
+            self._cache.clear()
+            self._unknown.clear()
         else:
-            raise KeyError("no pem file for " + hostname)
+            self._cache.pop(hostname)
+            self._unknown.pop(hostname, None)
+
+
+    def prewarm(self, reactor):
+        """
+        Load every certificate in the directory, and build its context, in
+        the reactor's thread pool, then add them all to the cache.
+
+        @param reactor: The reactor whose thread pool to use.
+
+        @return: a L{Deferred} that fires with the number of hosts loaded
+            once they are all in the cache.  Files that fail to load are
+            logged and skipped.
+        """
+        threadPool = reactor.getThreadPool()
+
+        # Threads racing through the interner may load the same certificate
+        # or build the same context twice; only one copy is kept.
+        def load(filePath):
+            identity = _fileIdentity(filePath)
+            options = certificateOptionsFromPileOfPEM(filePath.getContent(),
+                                                      self.interner)
+            options.getContext()
+            return identity, options
+
+        def store(entry, hostname):
+            if entry[0] is not None and hostname not in self._cache:
+                self._cache.put(hostname, entry[0], entry[1])
+            return 1
+
+        def failed(failure, filePath):
+            _log.failure("Could not load {path}", failure, path=filePath.path)
+            return 0
+
+        loads = []
+        for filePath in self.directoryPath.globChildren("*.pem"):
+            d = deferToThreadPool(reactor, threadPool, load, filePath)
+            d.addCallbacks(store, failed,
+                           callbackArgs=(filePath.basename()[:-len(".pem")],),
+                           errbackArgs=(filePath,))
+            loads.append(d)
+        return gatherResults(loads).addCallback(sum)
+
+
+
+def _fileIdentity(filePath):
+    """
+    Identify the current contents of a file without reading it.
+
+    @param filePath: The file to identify.
+    @type filePath: L{FilePath}
+
+    @return: a tuple of the inode number, modification time and size of the
+        file, or L{None} if it is not a regular file.
+    """
+    try:
+        st = os.stat(filePath.path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
@@ -0,0 +1,487 @@
+"""
+Certificates kept in a SQLite database rather than a directory.
+
+Import a L{HostDirectoryMap}-style directory with::
+
+    python -m txsni.sqlitemap <pemdir> <database>
+
+and serve the database with C{txsni:<database>:<sub-endpoint>}, or by
+passing an L{SQLiteCertificateMap} to L{SNIMap}.
+
+The database has one table, C{certificates}, with a row per host: its name,
+its DER encoded private keys and certificates (as laid out by
+L{txsni.store}), the C{version} in which the row last changed and the
+number of C{lookups} of it so far.  Every change - an import, L{put} or
+L{remove} - gives the rows it touches a new, higher version, and removed
+hosts are kept, without keys, so that running servers can find every
+change since the version they last saw through the index on C{version}.
+"""
+
+from __future__ import print_function
+
+import collections
+import sqlite3
+import sys
+import time
+
+from contextlib import contextmanager
+
+from OpenSSL.crypto import Error as CryptoError
+
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.logger import Logger
+from twisted.python.filepath import FilePath
+
+from txsni.cache import TieredCache
+from txsni.only_noticed_pypi_pem_after_i_wrote_this import (
+    Interner, _encodeOptions, _optionsFromDER,
+    certificateOptionsFromPileOfPEM,
+)
+from txsni.store import _packBlobs, _unpackBlobs
+
+_log = Logger()
+
+SQLITE_MAGIC = b"SQLite format 3\0"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS certificates (
+    hostname TEXT PRIMARY KEY,
+    keys BLOB,
+    certificates BLOB,
+    version INTEGER NOT NULL,
+    lookups INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS certificates_by_version
+    ON certificates (version);
+CREATE INDEX IF NOT EXISTS certificates_by_lookups
+    ON certificates (lookups);
+"""
+
+# The sqlite3 module prepares each distinct statement once per connection
+# and caches it, so these are only ever parsed once.
+_SELECT = "SELECT keys, certificates FROM certificates WHERE hostname = ?"
+_SELECT_HOT = ("SELECT hostname, keys, certificates FROM certificates "
+               "WHERE keys IS NOT NULL ORDER BY lookups DESC LIMIT ?")
+_SELECT_CHANGED = ("SELECT hostname, version FROM certificates "
+                   "WHERE version > ?")
+_SELECT_VERSION = "SELECT COALESCE(MAX(version), 0) FROM certificates"
+_UPSERT = ("INSERT INTO certificates (hostname, keys, certificates, version) "
+           "VALUES (?, ?, ?, ?) ON CONFLICT (hostname) DO UPDATE SET "
+           "keys = excluded.keys, certificates = excluded.certificates, "
+           "version = excluded.version")
+_REMOVE = ("UPDATE certificates SET keys = NULL, certificates = NULL, "
+           "version = ? WHERE hostname = ?")
+_COUNT_LOOKUPS = ("UPDATE certificates SET lookups = lookups + ? "
+                  "WHERE hostname = ?")
+
+
+def isSQLiteDatabase(path):
+    """
+    Does C{path} hold a SQLite database?
+
+    @type path: L{FilePath}
+    """
+    with path.open("r") as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+
+@contextmanager
+def _immediate(connection):
+    """
+    Run a write transaction on C{connection}, holding the database's write
+    lock from the start so that no other writer can take the same new
+    version.
+    """
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+
+def _countLookups(path, counts, timeout):
+    """
+    Add C{counts}, a L{collections.Counter} of lookups by hostname, to the
+    database at C{path}, through a connection of its own so that it can be
+    called from any thread.
+    """
+    connection = sqlite3.connect(path.path, timeout=timeout,
+                                 isolation_level=None)
+    try:
+        with _immediate(connection):
+            connection.executemany(
+                _COUNT_LOOKUPS,
+                [(count, hostname) for hostname, count in counts.items()],
+            )
+    finally:
+        connection.close()
+
+
+
+class SQLiteCertificateMap(object):
+    """
+    A mapping of hostnames to L{CertificateOptions}, read from a SQLite
+    database.
+
+    Options are cached per hostname once loaded, so each host's context is
+    only built once.  L{refresh} drops the ones that have changed in the
+    database since it last looked, by querying for rows with a newer
+    version; call it periodically to pick up updates.  With
+    C{contextBudget}, only the hosts used most recently keep their options,
+    within that many bytes; see L{TieredCache}.  The number of
+    lookups of each host is counted in memory and written back by
+    L{refresh} too, so that L{preload} can load the busiest hosts first.
+
+    Hostnames not in the database are remembered for C{unknownTTL} seconds,
+    up to C{unknownCacheSize} of them, so repeated requests for them do not
+    query it; a host added under such a name is noticed by the next
+    L{refresh}, or once that time has passed.
+
+    The database is only ever locked briefly, but a server must not wait
+    on another process holding it: each statement gives up after
+    C{timeout} seconds, and a lookup or L{refresh} that does is logged and
+    left for later.
+
+    @ivar hits: The number of lookups answered from the cache.
+    @ivar misses: The number of lookups that had to load a row.
+    @ivar unknown: The number of lookups for hostnames not in the database.
+    @ivar version: The newest change seen by L{refresh}.
+    @ivar interner: The L{Interner} through which hosts with the same
+        certificates share them.
+    """
+    def __init__(self, path, interner=None, contextBudget=None,
+                 idleTimeout=None, clock=None, unknownTTL=10.0,
+                 unknownCacheSize=10000, timeout=0.1, reactor=None):
+        """
+        @param path: The database, which is created if it does not exist.
+        @type path: L{FilePath}
+
+        @param reactor: The reactor in whose thread pool L{refresh} writes
+            back the lookup counts; without one, it writes them itself.
+        """
+        self.path = path
+        self.interner = Interner() if interner is None else interner
+        self.unknownTTL = unknownTTL
+        self.unknownCacheSize = unknownCacheSize
+        self.timeout = timeout
+        self._reactor = reactor
+        self._now = time.time if clock is None else clock.seconds
+        # Transactions are begun explicitly; see _writing.
+        self._connection = sqlite3.connect(path.path, timeout=timeout,
+                                           isolation_level=None)
+        self._connection.executescript(_SCHEMA)
+        self._cache = TieredCache(contextBudget, 0, idleTimeout, clock,
+                                  self.interner)
+        self._unknown = collections.OrderedDict()
+        self._lookups = collections.Counter()
+        self._lookupsWritten = None
+        self.hits = 0
+        self.misses = 0
+        self.unknown = 0
+        self.version = self._currentVersion()
+
+
+    def close(self):
+        """
+        Write back the lookup counts and close the database.
+        """
+        if self._lookups:
+            _countLookups(self.path, self._lookups, self.timeout)
+            self._lookups.clear()
+        self._connection.close()
+
+
+    def _currentVersion(self):
+        return self._connection.execute(_SELECT_VERSION).fetchone()[0]
+
+
+    def _writing(self):
+        """
+        Run a write transaction on the map's connection.
+
+        @see: L{_immediate}
+        """
+        return _immediate(self._connection)
+
+
+    def __getitem__(self, hostname):
+        options = self.get(hostname)
+        if options is None:
+            raise KeyError("no certificate for %r" % (hostname,))
+        return options
+
+
+    def get(self, hostname, default=None):
+        """
+        Look up the options for C{hostname}.
+
+        @return: the options, or C{default} if C{hostname} is not in the
+            database.
+        """
+        if hostname is None:
+            hostname = u"DEFAULT"
+        elif isinstance(hostname, bytes):
+            try:
+                hostname = hostname.decode("ascii")
+            except UnicodeDecodeError:
+                self.unknown += 1
+                return default
+        cached = self._cache.get(hostname)
+        if cached is not None:
+            self.hits += 1
+            self._lookups[hostname] += 1
+            return cached[1]
+        expires = self._unknown.get(hostname)
+        if expires is not None:
+            if expires > self._now():
+                self.unknown += 1
+                return default
+            del self._unknown[hostname]
+        try:
+            row = self._connection.execute(_SELECT, (hostname,)).fetchone()
+        except sqlite3.OperationalError:
+            _log.failure("Could not look up {hostname} in {path}",
+                         hostname=hostname, path=self.path.path)
+            return default
+        if row is None or row[0] is None:
+            self._rememberUnknown(hostname)
+            self.unknown += 1
+            return default
+        self.misses += 1
+        self._lookups[hostname] += 1
+        return self._load(hostname, row[0], row[1])
+
+
+    def _rememberUnknown(self, hostname):
+        self._unknown[hostname] = self._now() + self.unknownTTL
+        while len(self._unknown) > self.unknownCacheSize:
+            self._unknown.popitem(last=False)
+
+
+    def _load(self, hostname, keys, certificates):
+        encoded = (_unpackBlobs(keys), _unpackBlobs(certificates))
+        options = _optionsFromDER(self.interner, *encoded)
+        self._cache.put(hostname, None, options, encoded)
+        return options
+
+
+    def preload(self, count):
+        """
+        Load the C{count} most looked up hosts in one query.
+
+        @return: the number of hosts loaded.
+        """
+        loaded = 0
+        for hostname, keys, certificates in self._connection.execute(
+                _SELECT_HOT, (count,)):
+            if hostname not in self._cache:
+                self._load(hostname, keys, certificates)
+                loaded += 1
+        return loaded
+
+
+    def refresh(self):
+        """
+        Forget what is cached about every host that has changed since the
+        last refresh, and write back the lookup counts, in the reactor's
+        thread pool if the map has a reactor.
+
+        If the database stays locked for longer than C{timeout}, the
+        failure is logged and the changes and counts are left for the next
+        refresh.
+
+        @return: the number of hosts that changed.
+        """
+        self._writeLookups()
+        try:
+            changed = self._connection.execute(_SELECT_CHANGED,
+                                               (self.version,)).fetchall()
+        except sqlite3.OperationalError:
+            _log.failure("Could not check {path} for changes",
+                         path=self.path.path)
+            return 0
+        for hostname, version in changed:
+            self._cache.pop(hostname)
+            self._unknown.pop(hostname, None)
+            self.version = max(self.version, version)
+        return len(changed)
+
+
+    def _writeLookups(self):
+        """
+        Write back the lookups counted since the last time, unless the last
+        write is still going.
+        """
+        if not self._lookups or self._lookupsWritten is not None:
+            return
+        counts, self._lookups = self._lookups, collections.Counter()
+        if self._reactor is None:
+            d = maybeDeferred(_countLookups, self.path, counts, self.timeout)
+        else:
+            d = deferToThreadPool(self._reactor,
+                                  self._reactor.getThreadPool(),
+                                  _countLookups, self.path, counts,
+                                  self.timeout)
+        d.addErrback(self._lookupsNotWritten, counts)
+        if not d.called:
+            self._lookupsWritten = d
+            d.addBoth(self._lookupsDone)
+
+
+    def _lookupsNotWritten(self, failure, counts):
+        _log.failure("Could not write lookup counts to {path}", failure,
+                     path=self.path.path)
+        self._lookups.update(counts)
+
+
+    def _lookupsDone(self, result):
+        self._lookupsWritten = None
+        return result
+
+
+    def putMany(self, entries):
+        """
+        Add or replace the options of some hosts, in one transaction and one
+        new version.
+
+        @param entries: C{(hostname, options)} pairs, where C{hostname} is
+            text.
+
+        @return: the new version.
+        """
+        rows = []
+        for hostname, options in entries:
+            keys, certificates = _encodeOptions(options)
+            rows.append((hostname, _packBlobs(keys),
+                         _packBlobs(certificates)))
+        with self._writing():
+            version = self._currentVersion() + 1
+            self._connection.executemany(
+                _UPSERT,
+                [row + (version,) for row in rows],
+            )
+        return version
+
+
+    def put(self, hostname, options):
+        """
+        Add or replace the options of C{hostname}.
+
+        @return: the new version.
+        """
+        return self.putMany([(hostname, options)])
+
+
+    def remove(self, hostname):
+        """
+        Remove C{hostname}.
+
+        @return: the new version.
+        """
+        with self._writing():
+            version = self._currentVersion() + 1
+            self._connection.execute(_REMOVE, (version, hostname))
+        return version
+
+
+    @property
+    def cacheSize(self):
+        """
+        The number of hosts whose options are cached.
+        """
+        return len(self._cache)
+
+
+    def memoryUsage(self):
+        """
+        The estimated bytes used by cached options.
+
+        @see: L{TieredCache.memoryUsage}
+        """
+        return self._cache.memoryUsage()
+
+
+    def invalidate(self, hostname=None):
+        """
+        Forget what is cached about C{hostname}, or about every host if it
+        is L{None}.
+        """
+        if hostname is None:
+            self._cache.clear()
+            self._unknown.clear()
+        else:
+            if isinstance(hostname, bytes):
+                hostname = hostname.decode("ascii")
+            self._cache.pop(hostname)
+            self._unknown.pop(hostname, None)
+
+
+
+def importDirectory(directoryPath, path, batchSize=1000):
+    """
+    Import the C{<hostname>.pem} files in a directory into a database, in
+    batches of C{batchSize} hosts per transaction.
+
+    @param directoryPath: The directory, as for L{HostDirectoryMap}.
+    @type directoryPath: L{FilePath}
+
+    @param path: The database, which is created if it does not exist.
+    @type path: L{FilePath}
+
+    @return: a tuple of the number of hosts imported and a L{list} of the
+        L{FilePath}s of the files that could not be loaded.
+    """
+    # Nothing is waiting on an import, so it can wait out servers writing
+    # back their lookup counts.
+    database = SQLiteCertificateMap(path, timeout=5.0)
+    imported = 0
+    failed = []
+    batch = []
+    try:
+        for filePath in sorted(directoryPath.globChildren("*.pem")):
+            try:
+                options = certificateOptionsFromPileOfPEM(
+                    filePath.getContent(), database.interner
+                )
+            except (ValueError, CryptoError):
+                failed.append(filePath)
+                continue
+            batch.append((filePath.basename()[:-len(".pem")], options))
+            if len(batch) >= batchSize:
+                database.putMany(batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            database.putMany(batch)
+            imported += len(batch)
+    finally:
+        database.close()
+    return imported, failed
+
+
+
+def main(argv=None):
+    """
+    Import a directory of PEM files into a database.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("usage: python -m txsni.sqlitemap <pemdir> <database>",
+              file=sys.stderr)
+        return 2
+    imported, failed = importDirectory(FilePath(argv[0]), FilePath(argv[1]))
+    for filePath in failed:
+        print("skipped %s: could not load it" % (filePath.path,),
+              file=sys.stderr)
+    print("imported %d hosts into %s" % (imported, argv[1]))
+    return 1 if failed else 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
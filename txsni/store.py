@@ -0,0 +1,372 @@
+"""
+A compiled certificate store: every host's key and certificate chain in one
+indexed file, for directories too large to serve one PEM file at a time.
+
+Build a store from a L{HostDirectoryMap}-style directory with::
+
+    python -m txsni.store <pemdir> <store>
+
+and serve it with C{txsni:<store>:<sub-endpoint>}, or by passing a
+L{CertificateStore} to L{SNIMap}.
+
+The file starts with a header, C{magic, bucketCount, hostCount}, followed
+by an open-addressed hash table of C{bucketCount} buckets of C{hash,
+padding, offset} - the hostname's 32-bit CRC32, 32 unused bits and a 64-bit
+offset - where an offset of zero marks an empty bucket, and then one record
+per host: C{hostnameLength, keyCount, certificateCount}, the ASCII
+hostname, the DER encoded private keys and then the DER encoded
+certificates, each preceded by its length.  The first C{keyCount}
+certificates are those of the keys, in the same order; the rest are their
+chain.  All integers are little-endian.
+"""
+
+from __future__ import print_function
+
+import mmap
+import struct
+import sys
+import zlib
+
+from OpenSSL.crypto import Error as CryptoError
+
+from twisted.python.filepath import FilePath
+
+from txsni.cache import TieredCache
+from txsni.only_noticed_pypi_pem_after_i_wrote_this import (
+    Interner, _encodeOptions, _optionsFromDER,
+    certificateOptionsFromPileOfPEM,
+)
+
+MAGIC = b"TXSNI02\0"
+_HEADER = struct.Struct("<8sII")
+_BUCKET = struct.Struct("<IIQ")
+_RECORD = struct.Struct("<HHH")
+_LENGTH = struct.Struct("<I")
+
+
+def _hash(hostname):
+    return zlib.crc32(hostname) & 0xffffffff
+
+
+
+def _bucketCount(hostCount):
+    """
+    The number of buckets for C{hostCount} hosts: a power of two that keeps
+    the table at most half full.
+    """
+    count = 1
+    while count < hostCount * 2:
+        count *= 2
+    return count
+
+
+
+def _packBlobs(blobs):
+    """
+    Join C{blobs}, each preceded by its length.
+    """
+    parts = []
+    for blob in blobs:
+        parts.append(_LENGTH.pack(len(blob)))
+        parts.append(blob)
+    return b"".join(parts)
+
+
+
+def _unpackBlobs(data, count=None, offset=0):
+    """
+    Split C{count} blobs joined by L{_packBlobs} out of C{data}, starting at
+    C{offset}, or every blob to the end of C{data} if C{count} is L{None}.
+    """
+    blobs = []
+    while offset < len(data) if count is None else len(blobs) < count:
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        blobs.append(data[offset:offset + length])
+        offset += length
+    return blobs
+
+
+
+def _encodeRecord(hostname, options):
+    """
+    Encode the record for C{hostname}.
+
+    @type hostname: L{bytes}
+    @type options: L{CertificateOptions}
+
+    @rtype: L{bytes}
+    """
+    keys, certificates = _encodeOptions(options)
+    return b"".join([
+        _RECORD.pack(len(hostname), len(keys), len(certificates)),
+        hostname, _packBlobs(keys + certificates),
+    ])
+
+
+
+def writeStore(path, entries):
+    """
+    Write a certificate store.
+
+    The store is written next to C{path} and renamed into place, so a
+    running server never sees a partly written one.
+
+    @param path: Where to write the store.
+    @type path: L{FilePath}
+
+    @param entries: The hosts to include, as C{(hostname, options)} pairs,
+        where C{hostname} is L{bytes} and C{options} is a
+        L{CertificateOptions} with a private key and certificate.
+
+    @return: the number of hosts written.
+    """
+    records = [(hostname, _encodeRecord(hostname, options))
+               for hostname, options in entries]
+    bucketCount = _bucketCount(len(records))
+    buckets = [(0, 0)] * bucketCount
+    offset = _HEADER.size + _BUCKET.size * bucketCount
+    for hostname, record in records:
+        hashValue = _hash(hostname)
+        index = hashValue & (bucketCount - 1)
+        while buckets[index][1]:
+            index = (index + 1) & (bucketCount - 1)
+        buckets[index] = (hashValue, offset)
+        offset += len(record)
+
+    temporary = path.temporarySibling(".tmp")
+    with temporary.open("w") as f:
+        f.write(_HEADER.pack(MAGIC, bucketCount, len(records)))
+        for hashValue, recordOffset in buckets:
+            f.write(_BUCKET.pack(hashValue, 0, recordOffset))
+        for hostname, record in records:
+            f.write(record)
+    temporary.moveTo(path)
+    return len(records)
+
+
+
+def buildStore(directoryPath, path):
+    """
+    Compile the C{<hostname>.pem} files in a directory into a store.
+
+    @param directoryPath: The directory, as for L{HostDirectoryMap}.
+    @type directoryPath: L{FilePath}
+
+    @param path: Where to write the store.
+    @type path: L{FilePath}
+
+    @return: a tuple of the number of hosts written and a L{list} of the
+        L{FilePath}s of the files that could not be loaded.
+    """
+    entries = []
+    failed = []
+    interner = Interner()
+    for filePath in sorted(directoryPath.globChildren("*.pem")):
+        hostname = filePath.basename()[:-len(".pem")]
+        try:
+            options = certificateOptionsFromPileOfPEM(filePath.getContent(),
+                                                      interner)
+            hostname = hostname.encode("ascii")
+        except (ValueError, CryptoError):
+            failed.append(filePath)
+            continue
+        entries.append((hostname, options))
+    return writeStore(path, entries), failed
+
+
+
+class CertificateStore(object):
+    """
+    A mapping of hostnames to L{CertificateOptions}, read from a store
+    written by L{writeStore} through a memory map.
+
+    A lookup hashes the hostname, probes the table and loads the DER encoded
+    key and certificates of the matching record; the options are then cached
+    per hostname, like L{HostDirectoryMap}'s, so that each host's context is
+    only built once.  With C{contextBudget}, only the hosts used most
+    recently keep their options, within that many bytes; see L{TieredCache}.
+
+    @ivar hits: The number of lookups answered from the cache.
+    @ivar misses: The number of lookups that had to load a record.
+    @ivar unknown: The number of lookups for hostnames not in the store.
+    """
+    def __init__(self, path, interner=None, contextBudget=None,
+                 idleTimeout=None, clock=None):
+        """
+        @param path: The store to read.
+        @type path: L{FilePath}
+
+        @param interner: The L{Interner} through which hosts with the same
+            certificates share them; by default, one for this store alone.
+
+        @raise ValueError: if C{path} is not a certificate store.
+        """
+        self.path = path
+        self.interner = Interner() if interner is None else interner
+        self._cache = TieredCache(contextBudget, 0, idleTimeout, clock,
+                                  self.interner)
+        self.hits = 0
+        self.misses = 0
+        self.unknown = 0
+        self._map = None
+        self.reload()
+
+
+    def reload(self):
+        """
+        Map the store at C{path} again, to pick up a new one written in its
+        place, and forget every cached host.
+        """
+        with self.path.open("r") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bucketCount, hostCount = _HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            mapped.close()
+            raise ValueError("%s is not a certificate store"
+                             % (self.path.path,))
+        if self._map is not None:
+            self._map.close()
+        self._map = mapped
+        self._bucketCount = bucketCount
+        self._hostCount = hostCount
+        self._cache.clear()
+
+
+    def close(self):
+        """
+        Unmap the store.
+        """
+        self._map.close()
+
+
+    def __len__(self):
+        return self._hostCount
+
+
+    def __getitem__(self, hostname):
+        options = self.get(hostname)
+        if options is None:
+            raise KeyError("no certificate for %r" % (hostname,))
+        return options
+
+
+    def get(self, hostname, default=None):
+        """
+        Look up the options for C{hostname}.
+
+        @return: the options, or C{default} if C{hostname} is not in the
+            store.
+        """
+        if hostname is None:
+            hostname = b"DEFAULT"
+        elif not isinstance(hostname, bytes):
+            try:
+                hostname = hostname.encode("ascii")
+            except UnicodeEncodeError:
+                self.unknown += 1
+                return default
+        cached = self._cache.get(hostname)
+        if cached is not None:
+            self.hits += 1
+            return cached[1]
+        offset = self._find(hostname)
+        if offset is None:
+            self.unknown += 1
+            return default
+        self.misses += 1
+        encoded = self._load(offset)
+        options = _optionsFromDER(self.interner, *encoded)
+        self._cache.put(hostname, None, options, encoded)
+        return options
+
+
+    def _find(self, hostname):
+        """
+        Find the record for C{hostname}.
+
+        @return: the offset of the record, or L{None}.
+        """
+        mapped = self._map
+        mask = self._bucketCount - 1
+        hashValue = _hash(hostname)
+        index = hashValue & mask
+        while True:
+            bucketHash, _, offset = _BUCKET.unpack_from(
+                mapped, _HEADER.size + index * _BUCKET.size
+            )
+            if not offset:
+                return None
+            if bucketHash == hashValue:
+                length = _RECORD.unpack_from(mapped, offset)[0]
+                start = offset + _RECORD.size
+                if mapped[start:start + length] == hostname:
+                    return offset
+            index = (index + 1) & mask
+
+
+    def _load(self, offset):
+        """
+        Read the DER encoded keys and certificates of the record at
+        C{offset}.
+        """
+        mapped = self._map
+        hostnameLength, keyCount, certificateCount = _RECORD.unpack_from(
+            mapped, offset
+        )
+        blobs = _unpackBlobs(mapped, keyCount + certificateCount,
+                             offset + _RECORD.size + hostnameLength)
+        return blobs[:keyCount], blobs[keyCount:]
+
+
+    @property
+    def cacheSize(self):
+        """
+        The number of hosts whose options are cached.
+        """
+        return len(self._cache)
+
+
+    def memoryUsage(self):
+        """
+        The estimated bytes used by cached options.
+
+        @see: L{TieredCache.memoryUsage}
+        """
+        return self._cache.memoryUsage()
+
+
+    def invalidate(self, hostname=None):
+        """
+        Forget the cached options for C{hostname}, or for every host if it
+        is L{None}.
+        """
+        if hostname is None:
+            self._cache.clear()
+        else:
+            if not isinstance(hostname, bytes):
+                hostname = hostname.encode("ascii")
+            self._cache.pop(hostname)
+
+
+
+def main(argv=None):
+    """
+    Compile a directory of PEM files into a certificate store.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("usage: python -m txsni.store <pemdir> <store>",
+              file=sys.stderr)
+        return 2
+    written, failed = buildStore(FilePath(argv[0]), FilePath(argv[1]))
+    for filePath in failed:
+        print("skipped %s: could not load it" % (filePath.path,),
+              file=sys.stderr)
+    print("wrote %d hosts to %s" % (written, argv[1]))
+    return 1 if failed else 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
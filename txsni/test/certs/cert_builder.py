@@ -3,7 +3,7 @@ from __future__ import absolute_import
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.x509.oid import NameOID
 
 from twisted.logger import Logger
@@ -109,20 +109,29 @@ def _build_root_cert():
     return certificate, private_key
 
 
-def _build_single_leaf(hostname, certfile, ca_cert, ca_key):
+def _build_single_leaf(hostname, certfile, ca_cert, ca_key, sans=None,
+                       key_type='rsa'):
     """
-    Builds a single leaf certificate, signed by the CA's private key.
+    Builds a single leaf certificate, signed by the CA's private key. The
+    certificate's subject alternative names are ``sans`` if given, or just
+    ``hostname`` otherwise. Its key is RSA-2048, or ECDSA P-256 if
+    ``key_type`` is ``'ecdsa'``.
     """
     if os.path.isfile(certfile):
         _LOGGER.info("{hostname} already exists, not regenerating",
                      hostname=hostname)
         return
 
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-        backend=default_backend()
-    )
+    if key_type == 'ecdsa':
+        private_key = ec.generate_private_key(
+            ec.SECP256R1(), backend=default_backend()
+        )
+    else:
+        private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048,
+            backend=default_backend()
+        )
     public_key = private_key.public_key()
     builder = x509.CertificateBuilder()
     builder = builder.subject_name(x509.Name([
@@ -141,7 +150,7 @@ def _build_single_leaf(hostname, certfile, ca_cert, ca_key):
     )
     builder = builder.add_extension(
         x509.SubjectAlternativeName([
-            x509.DNSName(hostname)
+            x509.DNSName(name) for name in (sans or [hostname])
         ]),
         critical=True,
     )
@@ -0,0 +1,213 @@
+"""
+Directories of many synthetic hosts, for tests and benchmarks at scale.
+
+Every host has an ECDSA P-256 key and a certificate issued by one of a few
+intermediates, which share a root; its file holds the key, the certificate
+and the intermediate, as a real host's would.  Most hosts are named
+C{host<i>.example.test} and also cover C{www.host<i>.example.test}; every
+tenth is instead C{site<i>.example.test}, with a wildcard for its
+subdomains.  The directory also has a C{DEFAULT.pem}, and the root is kept
+beside the directory for clients that want to verify the hosts.
+
+Generated directories are cached on disk, under C{$TXSNI_FIXTURE_CACHE} or
+the system's temporary directory, and reused by later runs.
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import os
+import shutil
+import tempfile
+import uuid
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from twisted.python.filepath import FilePath
+
+# Bump this whenever the layout of the generated directories changes, so
+# that stale caches are not reused.
+FIXTURE_VERSION = 1
+
+WILDCARD_EVERY = 10
+INTERMEDIATES = 4
+
+_VALIDITY = datetime.timedelta(10 * 365)
+_COMPLETE = 'COMPLETE'
+
+
+def _cacheDirectory():
+    return FilePath(os.environ.get('TXSNI_FIXTURE_CACHE') or
+                    os.path.join(tempfile.gettempdir(), 'txsni-fixtures'))
+
+
+
+def hostNames(index):
+    """
+    Name synthetic host C{index}.
+
+    @return: a tuple of the host's name, which its file is named for, and
+        the names its certificate covers.
+    """
+    if index % WILDCARD_EVERY == WILDCARD_EVERY - 1:
+        hostname = u'site%d.example.test' % (index,)
+        return hostname, [hostname, u'*.' + hostname]
+    hostname = u'host%d.example.test' % (index,)
+    return hostname, [hostname, u'www.' + hostname]
+
+
+
+class SyntheticHosts(object):
+    """
+    A directory of synthetic hosts.
+
+    @ivar directory: The L{FilePath} of the directory, laid out for
+        L{HostDirectoryMap}.
+    @ivar rootPath: The L{FilePath} of the PEM encoded root certificate.
+    @ivar count: The number of hosts, not counting C{DEFAULT}.
+    """
+    def __init__(self, path, count):
+        self.directory = path.child('hosts')
+        self.rootPath = path.child('root.pem')
+        self.count = count
+
+
+    @property
+    def hostnames(self):
+        """
+        The name of each host, as sent in SNI, in order.
+
+        @rtype: L{list} of L{bytes}
+        """
+        return [hostNames(index)[0].encode('ascii')
+                for index in range(self.count)]
+
+
+    @property
+    def alternativeNames(self):
+        """
+        A name covered by each host's certificate other than its own, such
+        as C{www.host0.example.test} or C{a.site9.example.test}, in order.
+
+        @rtype: L{list} of L{bytes}
+        """
+        names = []
+        for index in range(self.count):
+            alternative = hostNames(index)[1][1]
+            if alternative.startswith(u'*.'):
+                alternative = u'a' + alternative[1:]
+            names.append(alternative.encode('ascii'))
+        return names
+
+
+
+def syntheticHosts(count, cacheDirectory=None):
+    """
+    Get a directory of C{count} synthetic hosts, generating it unless it is
+    already cached.
+
+    @param cacheDirectory: The L{FilePath} of the directory to cache it in,
+        if not the default.
+
+    @rtype: L{SyntheticHosts}
+    """
+    if cacheDirectory is None:
+        cacheDirectory = _cacheDirectory()
+    path = cacheDirectory.child('v%d-%d' % (FIXTURE_VERSION, count))
+    if not path.child(_COMPLETE).exists():
+        if not cacheDirectory.exists():
+            cacheDirectory.makedirs(ignoreExistingDirectory=True)
+        # Generate elsewhere and rename, so that concurrent runs never see a
+        # half-written directory.
+        scratch = FilePath(tempfile.mkdtemp(dir=cacheDirectory.path))
+        try:
+            _generate(scratch, count)
+            scratch.child(_COMPLETE).touch()
+            try:
+                os.rename(scratch.path, path.path)
+            except OSError:
+                if not path.child(_COMPLETE).exists():
+                    raise
+        finally:
+            if scratch.exists():
+                shutil.rmtree(scratch.path)
+    return SyntheticHosts(path, count)
+
+
+
+def _name(commonName):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, commonName)])
+
+
+
+def _issue(subject, publicKey, issuer, issuerKey, now, extensions):
+    builder = x509.CertificateBuilder(
+        issuer_name=issuer,
+        subject_name=subject,
+        public_key=publicKey,
+        serial_number=int(uuid.uuid4()),
+        not_valid_before=now - datetime.timedelta(1),
+        not_valid_after=now + _VALIDITY,
+    )
+    for extension, critical in extensions:
+        builder = builder.add_extension(extension, critical=critical)
+    return builder.sign(issuerKey, hashes.SHA256())
+
+
+
+def _pem(privateKey, *certificates):
+    return privateKey.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ) + b''.join(certificate.public_bytes(serialization.Encoding.PEM)
+                 for certificate in certificates)
+
+
+
+def _generate(path, count):
+    """
+    Write a root, its intermediates and C{count} hosts, plus C{DEFAULT},
+    to C{path}.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    curve = ec.SECP256R1()
+
+    rootKey = ec.generate_private_key(curve)
+    rootName = _name(u'txsni synthetic root')
+    root = _issue(rootName, rootKey.public_key(), rootName, rootKey, now,
+                  [(x509.BasicConstraints(ca=True, path_length=1), True)])
+    path.child('root.pem').setContent(
+        root.public_bytes(serialization.Encoding.PEM))
+
+    intermediates = []
+    for index in range(INTERMEDIATES):
+        key = ec.generate_private_key(curve)
+        name = _name(u'txsni synthetic intermediate %d' % (index,))
+        certificate = _issue(
+            name, key.public_key(), rootName, rootKey, now,
+            [(x509.BasicConstraints(ca=True, path_length=0), True)])
+        intermediates.append((name, key, certificate,
+                              certificate.public_bytes(
+                                  serialization.Encoding.PEM)))
+
+    directory = path.child('hosts')
+    directory.makedirs()
+    leafConstraints = (x509.BasicConstraints(ca=False, path_length=None),
+                       True)
+    hosts = [(hostNames(index), index) for index in range(count)]
+    hosts.append(((u'DEFAULT', [u'default.example.test']), count))
+    for (hostname, names), index in hosts:
+        issuerName, issuerKey, _, issuerPEM = intermediates[
+            index % INTERMEDIATES]
+        key = ec.generate_private_key(curve)
+        certificate = _issue(
+            _name(names[0]), key.public_key(), issuerName, issuerKey, now,
+            [leafConstraints,
+             (x509.SubjectAlternativeName([x509.DNSName(name)
+                                           for name in names]), False)])
+        directory.child(hostname + u'.pem').setContent(
+            _pem(key, certificate) + issuerPEM)
@@ -1,13 +1,62 @@
+from twisted.internet.defer import Deferred
 from twisted.protocols.tls import TLSMemoryBIOFactory
 
+from txsni.clienthello import ClientHelloFactory
+from txsni.offload import OffloadingTLSFactory
+
 class TLSEndpoint(object):
-    def __init__(self, endpoint, contextFactory):
+    def __init__(self, endpoint, contextFactory, ready=None, resolve=None,
+                 resolveTimeout=None, handshakePool=None):
+        """
+        @param ready: An optional L{Deferred} that fires once
+            C{contextFactory} is ready to serve handshakes; listening is
+            put off until then.
+
+        @param resolve: An optional callable that each connection's
+            L{txsni.clienthello.ClientHello} is passed to before the
+            handshake starts, and which may return a L{Deferred} to hold the
+            handshake up until the certificate is available; see
+            L{txsni.clienthello.AsyncMapping}.
+
+        @param resolveTimeout: How many seconds to hold a handshake up for,
+            or L{None} for as long as C{resolve} takes.
+
+        @param handshakePool: An optional L{txsni.offload.HandshakePool} to
+            run each connection's handshake in, rather than the reactor
+            thread; it is started when the endpoint starts listening.
+        """
         self.endpoint = endpoint
         self.contextFactory = contextFactory
+        self.ready = ready
+        self.resolve = resolve
+        self.resolveTimeout = resolveTimeout
+        self.handshakePool = handshakePool
 
 
     def listen(self, factory):
-        return self.endpoint.listen(TLSMemoryBIOFactory(
-            self.contextFactory, False, factory
-        ))
+        if self.handshakePool is None:
+            tlsFactory = TLSMemoryBIOFactory(self.contextFactory, False,
+                                             factory)
+        else:
+            self.handshakePool.start()
+            tlsFactory = OffloadingTLSFactory(self.contextFactory, False,
+                                              factory, self.handshakePool)
+        if self.resolve is not None:
+            tlsFactory = ClientHelloFactory(tlsFactory, self.resolve,
+                                            timeout=self.resolveTimeout)
+        if self.ready is None:
+            return self.endpoint.listen(tlsFactory)
+        return self._whenReady().addCallback(
+            lambda _: self.endpoint.listen(tlsFactory)
+        )
+
+
+    def _whenReady(self):
+        whenReady = Deferred()
+
+        def fire(result):
+            whenReady.callback(None)
+            return result
 
+        self.ready.addBoth(fire)
+        return whenReady
@@ -0,0 +1,65 @@
+"""
+Keep L{HostDirectoryMap} caches up to date with inotify, on Linux.
+"""
+
+from twisted.internet import inotify
+
+_CHANGES = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE |
+            inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | inotify.IN_ATTRIB)
+
+_GONE = inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_IGNORED
+
+
+class HostDirectoryWatcher(object):
+    """
+    Watches the directories of one or more L{HostDirectoryMap}s and drops
+    cached entries as soon as their certificate files change.
+
+    While a mapping is watched it trusts its cache, so lookups of hosts that
+    have already been loaded are served without touching the filesystem.
+    Changes to the files a symbolic link in the directory points at, rather
+    than to the link itself, are not noticed.
+    """
+    def __init__(self, reactor=None):
+        self._notifier = inotify.INotify(reactor)
+        self._notifier.startReading()
+        self._mappings = []
+
+
+    def watch(self, mapping):
+        """
+        Start watching C{mapping}'s directory.  If it does not exist, the
+        mapping is left to check its files on every lookup.
+
+        @param mapping: The mapping to keep up to date.
+        @type mapping: L{HostDirectoryMap}
+        """
+        if not mapping.directoryPath.isdir():
+            return
+
+        def changed(ignored, filePath, mask):
+            if mask & _GONE:
+                mapping.watched = False
+                mapping.invalidate()
+                return
+            name = filePath.asTextMode().basename()
+            if name.endswith(u".pem"):
+                mapping.invalidate(name[:-len(u".pem")])
+
+        self._notifier.watch(mapping.directoryPath, mask=_CHANGES | _GONE,
+                             callbacks=[changed])
+        # Anything cached before the watch began may already be stale.
+        mapping.invalidate()
+        mapping.watched = True
+        self._mappings.append(mapping)
+
+
+    def stop(self):
+        """
+        Stop watching.  Watched mappings go back to checking their files on
+        every lookup.
+        """
+        self._notifier.loseConnection()
+        for mapping in self._mappings:
+            mapping.watched = False
+        self._mappings = []
@@ -0,0 +1,240 @@
+"""
+Spread TLS handshakes across several processes listening on one port.
+
+Each worker is a copy of the current process, started with the same command
+line and with C{TXSNI_WORKER} set in its environment, so it builds its own
+L{SNIMap} over the same certificate directory.  Every worker, including the
+original process, listens on the port with C{SO_REUSEPORT}, and the kernel
+spreads incoming connections between them.  Each worker notices new and
+changed certificates on its own, by checking the files or through inotify,
+so reloads need no coordination beyond the shared directory.
+
+Under C{twistd}, workers run in the foreground of the original process, with
+no pidfile, and log to its standard output rather than its logfile; see
+L{workerArguments}.
+"""
+
+import os
+import socket
+import sys
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.interfaces import IStreamServerEndpoint
+from twisted.internet.protocol import ProcessProtocol
+from twisted.logger import Logger
+
+_log = Logger()
+
+WORKER_ENVIRONMENT_VARIABLE = "TXSNI_WORKER"
+
+# twistd options naming files that only the original process may write.
+_TWISTD_EXCLUSIVE = ("pidfile", "logfile")
+
+
+def isWorker(environ=os.environ):
+    """
+    Is this process a worker started by a L{WorkerPool}?
+    """
+    return WORKER_ENVIRONMENT_VARIABLE in environ
+
+
+
+def _twistdParameters():
+    """
+    The long and short names of C{twistd}'s own options that take a value.
+    """
+    from twisted.python.reflect import accumulateClassList
+    from twisted.scripts.twistd import ServerOptions
+    parameters = []
+    accumulateClassList(ServerOptions, "optParameters", parameters)
+    longNames = set(parameter[0] for parameter in parameters)
+    shortNames = dict((parameter[1], parameter[0])
+                      for parameter in parameters if parameter[1])
+    return longNames, shortNames
+
+
+
+def workerArguments(argv):
+    """
+    The command line for a worker copy of a process started with C{argv}.
+
+    A copy of a C{twistd} process must not daemonize, and must not share the
+    original's pidfile, which it would refuse to start over, or its logfile,
+    which both would rotate.  So C{twistd}'s C{--pidfile} and C{--logfile}
+    options are removed, up to the name of the plugin it runs, and the copy
+    is given C{--nodaemon} and an empty C{--pidfile}.  Other command lines
+    are returned as they are.
+    """
+    if not os.path.basename(argv[0]).startswith("twistd"):
+        return list(argv)
+    longNames, shortNames = _twistdParameters()
+    arguments = [argv[0], "--nodaemon", "--pidfile="]
+    remaining = iter(argv[1:])
+    for argument in remaining:
+        if argument.startswith("--"):
+            name, equals, _ = argument[2:].partition("=")
+            hasValue = name in longNames and not equals
+            if name not in _TWISTD_EXCLUSIVE:
+                arguments.append(argument)
+                if hasValue:
+                    arguments.append(next(remaining, ""))
+            elif hasValue:
+                next(remaining, None)
+        elif argument.startswith("-") and len(argument) > 1:
+            # A cluster of short flags, the last of which may take a value:
+            # the rest of the argument, or else the next one.
+            for index in range(1, len(argument)):
+                name = shortNames.get(argument[index])
+                if name is None:
+                    continue
+                value = argument[index + 1:] or next(remaining, "")
+                if name not in _TWISTD_EXCLUSIVE:
+                    arguments.extend([argument[:index + 1], value])
+                elif index > 1:
+                    arguments.append(argument[:index])
+                break
+            else:
+                arguments.append(argument)
+        else:
+            # The plugin, whose options are its own.
+            arguments.append(argument)
+            arguments.extend(remaining)
+    return arguments
+
+
+
+@implementer(IStreamServerEndpoint)
+class ReusePortTCPEndpoint(object):
+    """
+    A TCP server endpoint whose port can be shared with other processes
+    through C{SO_REUSEPORT}.
+    """
+    def __init__(self, reactor, port, interface="", backlog=50):
+        self.reactor = reactor
+        self.port = port
+        self.interface = interface
+        self.backlog = backlog
+
+
+    def listen(self, factory):
+        return defer.execute(self._listen, factory)
+
+
+    def _listen(self, factory):
+        family = socket.AF_INET6 if ":" in self.interface else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.interface, self.port))
+            sock.listen(self.backlog)
+            sock.setblocking(False)
+            return self.reactor.adoptStreamPort(sock.fileno(), family,
+                                                factory)
+        finally:
+            # The reactor has its own copy of the socket now.
+            sock.close()
+
+
+
+class _WorkerProtocol(ProcessProtocol):
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.ended = defer.Deferred()
+
+
+    def processEnded(self, reason):
+        self.pool._workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+
+class WorkerPool(object):
+    """
+    Keeps C{count - 1} copies of this process running as workers alongside
+    it, restarting any that exit until the pool is stopped.
+
+    @ivar argv: The command line the workers run with the current Python
+        interpreter; by default, the one this process was started with, as
+        adjusted by L{workerArguments}.
+    """
+    def __init__(self, reactor, count, argv=None, environ=None,
+                 respawnDelay=1.0):
+        self.reactor = reactor
+        self.count = count
+        self.argv = workerArguments(sys.argv if argv is None else argv)
+        self.environ = dict(os.environ if environ is None else environ)
+        self.respawnDelay = respawnDelay
+        self._workers = {}
+        self._stopping = False
+
+
+    def start(self):
+        """
+        Start the workers, and stop them again when the reactor shuts down.
+        """
+        for index in range(1, self.count):
+            self._spawn(index)
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+
+    def stop(self):
+        """
+        Stop every worker.
+
+        @return: a L{Deferred} that fires once they have all exited.
+        """
+        self._stopping = True
+        ended = []
+        for worker in list(self._workers.values()):
+            ended.append(worker.ended)
+            try:
+                worker.transport.signalProcess("TERM")
+            except ProcessExitedAlready:
+                pass
+        return defer.gatherResults(ended)
+
+
+    def _spawn(self, index):
+        environ = dict(self.environ)
+        environ[WORKER_ENVIRONMENT_VARIABLE] = str(index)
+        worker = _WorkerProtocol(self, index)
+        argv = [sys.executable] + self.argv
+        self.reactor.spawnProcess(worker, sys.executable, argv, env=environ,
+                                  childFDs={0: "w", 1: 1, 2: 2})
+        self._workers[index] = worker
+
+
+    def _workerEnded(self, worker, reason):
+        if self._workers.get(worker.index) is worker:
+            del self._workers[worker.index]
+        if self._stopping:
+            return
+        _log.warn("Worker {index} exited ({reason}), restarting",
+                  index=worker.index, reason=reason.value)
+        self.reactor.callLater(self.respawnDelay, self._spawn, worker.index)
+
+
+
+@implementer(IStreamServerEndpoint)
+class WorkerPoolEndpoint(object):
+    """
+    Listens with C{endpoint} and then, unless this process is itself a
+    worker, starts a L{WorkerPool} of copies of this process to listen
+    alongside it.
+    """
+    def __init__(self, endpoint, pool):
+        self.endpoint = endpoint
+        self.pool = pool
+
+
+    def listen(self, factory):
+        def startWorkers(port):
+            if not isWorker():
+                self.pool.start()
+            return port
+        return self.endpoint.listen(factory).addCallback(startWorkers)